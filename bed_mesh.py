@@ -4,7 +4,7 @@
 # Copyright (C) 2018-2019 Eric Callahan <arksine.code@gmail.com>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, math, json, collections
+import logging, math, time, json, collections, functools, os, copy
 from . import probe
 import numpy as np
 
@@ -36,6 +36,38 @@ def constrain(val, min_val, max_val):
 def lerp(t, v0, v1):
     return (1. - t) * v0 + t * v1
 
+# Control point indices and t values used by the vectorized cardinal
+# spline for every index of a mesh axis.  Cached, all meshes loaded by
+# FDC share the same geometry.
+@functools.lru_cache(maxsize=16)
+def spline_ctl_indices(mesh_cnt, mult):
+    idx = np.arange(mesh_cnt)
+    last_pt = mesh_cnt - 1 - mult
+    seg = np.minimum((idx // mult) * mult, last_pt)
+    p0 = np.maximum(seg - mult, 0)
+    p3 = np.minimum(seg + 2*mult, mesh_cnt - 1)
+    t = (idx - seg) / float(mult)
+    interp = np.nonzero(idx % mult)[0]
+    return (interp, p0[interp], seg[interp], seg[interp] + mult,
+            p3[interp], t[interp])
+
+# Barycentric lagrange weights mapping the probed points of an axis
+# to every index of the mesh axis
+@functools.lru_cache(maxsize=16)
+def lagrange_weights(mesh_min, mesh_dist, mesh_cnt, mult):
+    coords = mesh_min + mesh_dist * np.arange(mesh_cnt)
+    lpts = coords[::mult]
+    diff = lpts[:, None] - lpts[None, :]
+    np.fill_diagonal(diff, 1.)
+    bary = 1. / np.prod(diff, axis=1)
+    weights = np.zeros((mesh_cnt, len(lpts)))
+    probed = np.arange(0, mesh_cnt, mult)
+    weights[probed, probed // mult] = 1.
+    interp = np.nonzero(np.arange(mesh_cnt) % mult)[0]
+    w = bary / (coords[interp][:, None] - lpts[None, :])
+    weights[interp] = w / np.sum(w, axis=1)[:, None]
+    return weights
+
 # retreive commma separated pair from config
 def parse_config_pair(config, option, default, minval=None, maxval=None):
     pair = config.getintlist(option, (default, default))
@@ -104,11 +136,36 @@ class BedMesh:
         self.log_fade_complete = False
         self.base_fade_target = config.getfloat('fade_target', None)
         self.fade_target = 0.
+        self.vectorized_sampling = config.getboolean(
+            'vectorized_sampling', True)
+        # Double buffered mesh swap, see queue_mesh()
+        self.pending_mesh = None
+        # Bumped by every mesh change request, a deferred load prepared
+        # after a later request is dropped
+        self.mesh_generation = 0
+        self.swap_count = 0
+        # Rounded matrices of the active mesh, see update_status()
+        self.status_matrices = None
+        # Moves over cells that can't change z by split_delta_z are sent
+        # without splitting, the result is the same
+        self.flat_move_skip = config.getboolean('flat_move_skip', True)
+        self.mesh_moves = self.unsplit_moves = 0
+        self.last_swap_latency = self.max_swap_latency = 0.
         self.gcode = self.printer.lookup_object('gcode')
         self.splitter = MoveSplitter(config, self.gcode)
         # setup persistent storage
         self.pmgr = ProfileManager(config, self)
         self.save_profile = self.pmgr.save_profile
+        # Timing counters, the methods are only wrapped when enabled.
+        # This must be done before the transform is registered, gcode_move
+        # keeps a reference to move()
+        self.perf = None
+        if config.getboolean('perf_counters', False):
+            self.perf = PerfCounters()
+            self.perf.wrap(self, 'move')
+            self.perf.wrap(self.splitter, 'split')
+            self.perf.wrap(self.pmgr, 'load_profile')
+            self.perf.wrap(self.pmgr, 'tilt_load_profile')
         # register gcodes
         self.gcode.register_command(
             'BED_MESH_OUTPUT', self.cmd_BED_MESH_OUTPUT,
@@ -122,6 +179,9 @@ class BedMesh:
         self.gcode.register_command(
             'BED_MESH_OFFSET', self.cmd_BED_MESH_OFFSET,
             desc=self.cmd_BED_MESH_OFFSET_help)
+        self.gcode.register_command(
+            'BED_MESH_PERF_RESET', self.cmd_BED_MESH_PERF_RESET,
+            desc=self.cmd_BED_MESH_PERF_RESET_help)
         # Register transform
         gcode_move = self.printer.load_object(config, 'gcode_move')
         gcode_move.set_move_transform(self)
@@ -130,41 +190,101 @@ class BedMesh:
     def handle_connect(self):
         self.toolhead = self.printer.lookup_object('toolhead')
         self.bmc.print_generated_points(logging.info)
-    def set_mesh(self, mesh):
-        if mesh is not None and self.fade_end != self.FADE_DISABLE:
-            self.log_fade_complete = True
-            if self.base_fade_target is None:
-                self.fade_target = mesh.avg_z
-            else:
-                self.fade_target = self.base_fade_target
-                min_z, max_z = mesh.get_z_range()
-                if (not min_z <= self.fade_target <= max_z and
-                        self.fade_target != 0.):
-                    # fade target is non-zero, out of mesh range
-                    err_target = self.fade_target
-                    self.z_mesh = None
-                    self.fade_target = 0.
-                    raise self.gcode.error(
-                        "bed_mesh: ERROR, fade_target lies outside of mesh z "
-                        "range\nmin: %.4f, max: %.4f, fade_target: %.4f"
-                        % (min_z, max_z, err_target))
+    def _calc_fade_target(self, mesh):
+        if mesh is None or self.fade_end == self.FADE_DISABLE:
+            return 0.
+        if self.base_fade_target is None:
+            fade_target = mesh.avg_z
+        else:
+            fade_target = self.base_fade_target
             min_z, max_z = mesh.get_z_range()
-            if self.fade_dist <= max(abs(min_z), abs(max_z)):
-                self.z_mesh = None
-                self.fade_target = 0.
+            if (not min_z <= fade_target <= max_z and
+                    fade_target != 0.):
+                # fade target is non-zero, out of mesh range
                 raise self.gcode.error(
-                    "bed_mesh:  Mesh extends outside of the fade range, "
-                    "please see the fade_start and fade_end options in"
-                    "example-extras.cfg. fade distance: %.2f mesh min: %.4f"
-                    "mesh max: %.4f" % (self.fade_dist, min_z, max_z))
-        else:
-            self.fade_target = 0.
+                    "bed_mesh: ERROR, fade_target lies outside of mesh z "
+                    "range\nmin: %.4f, max: %.4f, fade_target: %.4f"
+                    % (min_z, max_z, fade_target))
+        min_z, max_z = mesh.get_z_range()
+        if self.fade_dist <= max(abs(min_z), abs(max_z)):
+            raise self.gcode.error(
+                "bed_mesh:  Mesh extends outside of the fade range, "
+                "please see the fade_start and fade_end options in"
+                "example-extras.cfg. fade distance: %.2f mesh min: %.4f"
+                "mesh max: %.4f" % (self.fade_dist, min_z, max_z))
+        return fade_target
+    def _activate_mesh(self, mesh, fade_target):
+        if mesh is not None and self.fade_end != self.FADE_DISABLE:
+            self.log_fade_complete = True
+        self.fade_target = fade_target
         self.z_mesh = mesh
         self.splitter.initialize(mesh, self.fade_target)
+    def _check_mesh(self, mesh):
+        # Fade target of a mesh about to be used, a mesh failing the
+        # fade checks is cleared
+        try:
+            return self._calc_fade_target(mesh)
+        except self.gcode.error:
+            self.z_mesh = None
+            self.fade_target = 0.
+            raise
+    def request_mesh(self):
+        # Stamp of a new mesh change request, it replaces the requests
+        # made before it (also a mesh still waiting for the next move)
+        self.mesh_generation += 1
+        self.pending_mesh = None
+        return self.mesh_generation
+    def set_mesh(self, mesh):
+        self.request_mesh()
+        self._activate_mesh(mesh, self._check_mesh(mesh))
         # cache the current position before a transform takes place
         gcode_move = self.printer.lookup_object('gcode_move')
         gcode_move.reset_last_position()
         self.update_status()
+    def update_mesh(self):
+        # The active mesh changed in place (thermal mesh temperature,
+        # tilt), the fade target and range are checked again like a new
+        # mesh.  There is no position reset.
+        self.request_mesh()
+        mesh = self.z_mesh
+        self._activate_mesh(mesh, self._check_mesh(mesh))
+        self.update_status()
+    def queue_mesh(self, mesh, prof_name, request_time, generation,
+                   on_publish=None):
+        # The mesh is published by the next move instead of immediately,
+        # there is no position reset, the first split of the next move
+        # goes to the new mesh height.  A failed check keeps the current
+        # mesh.  generation is the request_mesh() stamp of the request,
+        # the mesh is dropped (returns False) if a later request was made.
+        # on_publish is called when the mesh is published.
+        if generation != self.mesh_generation:
+            return False
+        fade_target = self._calc_fade_target(mesh)
+        self.pending_mesh = (mesh, fade_target, prof_name, request_time,
+                             on_publish)
+        return True
+    def _publish_pending_mesh(self):
+        mesh, fade_target, prof_name, request_time, on_publish = \
+            self.pending_mesh
+        self.pending_mesh = None
+        self._activate_mesh(mesh, fade_target)
+        self.pmgr.current_profile = prof_name
+        if on_publish is not None:
+            on_publish()
+        reactor = self.printer.get_reactor()
+        self.last_swap_latency = reactor.monotonic() - request_time
+        self.max_swap_latency = max(self.max_swap_latency,
+                                    self.last_swap_latency)
+        self.swap_count += 1
+        # Building the status isn't needed for the move
+        reactor.register_callback(lambda e: self.update_status())
+    def get_swap_status(self):
+        return {
+            "pending": self.pending_mesh is not None,
+            "swaps": self.swap_count,
+            "last_latency": self.last_swap_latency,
+            "max_latency": self.max_swap_latency
+        }
     def get_z_factor(self, z_pos):
         if z_pos >= self.fade_end:
             return 0.
@@ -198,6 +318,10 @@ class BedMesh:
             self.last_position[:] = [x, y, z - final_z_adj, e]
         return list(self.last_position)
     def move(self, newpos, speed):
+        if self.pending_mesh is not None:
+            self._publish_pending_mesh()
+        self._transform_move(newpos, speed, self.toolhead.move)
+    def _transform_move(self, newpos, speed, move_func):
         factor = self.get_z_factor(newpos[2])
         if self.z_mesh is None or not factor:
             # No mesh calibrated, or mesh leveling phased out.
@@ -207,19 +331,115 @@ class BedMesh:
                 logging.info(
                     "bed_mesh fade complete: Current Z: %.4f fade_target: %.4f "
                     % (z, self.fade_target))
-            self.toolhead.move([x, y, z + self.fade_target, e], speed)
+            move_func([x, y, z + self.fade_target, e], speed)
+        elif self.flat_move_skip and factor * self.z_mesh.get_move_z_range(
+                self.last_position[0], self.last_position[1],
+                newpos[0], newpos[1]) < self.splitter.split_delta_z:
+            # The splitter would not split this move, only the end
+            # offset is needed
+            self.mesh_moves += 1
+            self.unsplit_moves += 1
+            x, y, z, e = newpos
+            fade_target = self.fade_target
+            z_adj = factor * (self.z_mesh.calc_z(x, y) - fade_target) \
+                + fade_target
+            move_func([x, y, z + z_adj, e], speed)
         else:
+            self.mesh_moves += 1
             self.splitter.build_move(self.last_position, newpos, factor)
             while not self.splitter.traverse_complete:
                 split_move = self.splitter.split()
                 if split_move:
-                    self.toolhead.move(split_move, speed)
+                    move_func(split_move, speed)
                 else:
                     raise self.gcode.error(
                         "Mesh Leveling: Error splitting move ")
         self.last_position[:] = newpos
+    def transform_moves(self, positions):
+        # Batch version of move() for long runs of short segments (arcs),
+        # returns the toolhead positions for a sequence of gcode
+        # positions.  The end offsets are calculated with numpy, moves
+        # the splitter would split go through the scalar path.
+        if self.pending_mesh is not None:
+            self._publish_pending_mesh()
+        moves = []
+        def collect(pos, speed):
+            moves.append(list(pos))
+        if (len(positions) < 2 or self.z_mesh is None
+                or not self._can_batch(positions)):
+            for newpos in positions:
+                self._transform_move(newpos, 0., collect)
+            return moves
+        pos = np.asarray(positions, dtype=float)
+        path = np.vstack((self.last_position, pos))
+        factors = np.ones(len(pos))
+        fading = pos[:, 2] >= self.fade_start
+        if fading.any():
+            factors[fading] = [self.get_z_factor(z) for z in pos[fading, 2]]
+        z_mesh = self.z_mesh
+        mesh_z, z_range = z_mesh.calc_path(path[:, 0], path[:, 1])
+        fade_target = self.fade_target
+        z_adj = factors * (mesh_z[1:] - fade_target) + fade_target
+        # Moves the splitter would send unsplit
+        splitter = self.splitter
+        if self.flat_move_skip:
+            with np.errstate(invalid='ignore'):
+                flat = factors * z_range < splitter.split_delta_z
+            unsplit = flat | (factors == 0.)
+        else:
+            flat = np.zeros(len(pos), dtype=bool)
+            unsplit = factors == 0.
+            if splitter.split_mode == 'distance':
+                d = np.diff(path[:, :3], axis=0)
+                move_length = np.sqrt(d[:, 0] * d[:, 0] + d[:, 1] * d[:, 1]
+                                      + d[:, 2] * d[:, 2])
+                unsplit |= move_length <= splitter.move_check_distance
+        flat = flat.tolist()
+        unsplit = unsplit.tolist()
+        factors = factors.tolist()
+        z_adj = z_adj.tolist()
+        last_position = self.last_position
+        for i, newpos in enumerate(positions):
+            if not unsplit[i]:
+                self._transform_move(newpos, 0., collect)
+                continue
+            x, y, z, e = newpos
+            if factors[i]:
+                self.mesh_moves += 1
+                if flat[i]:
+                    self.unsplit_moves += 1
+            elif self.log_fade_complete:
+                self.log_fade_complete = False
+                logging.info(
+                    "bed_mesh fade complete: Current Z: %.4f fade_target: %.4f "
+                    % (z, self.fade_target))
+            moves.append([x, y, z + z_adj[i], e])
+            last_position[:] = newpos
+        return moves
+    def _can_batch(self, positions):
+        # In cell mode without flat_move_skip only the moves past the
+        # fade end skip the splitter, without them there is nothing to
+        # vectorize
+        if self.flat_move_skip or self.splitter.split_mode == 'distance':
+            return True
+        return max([pos[2] for pos in positions]) >= self.fade_end
+    def move_batch(self, positions, speed):
+        for newpos in self.transform_moves(positions):
+            self.toolhead.move(newpos, speed)
     def get_status(self, eventtime=None):
-        return self.status
+        status = dict(self.status)
+        status['profiles'] = self.pmgr.get_profiles()
+        if self.perf is not None:
+            # These change on every move, the status would be pushed to
+            # the clients continuously
+            status['perf'] = self.perf.get_status()
+            status['move_skip'] = {
+                'mesh_moves': self.mesh_moves,
+                'unsplit_moves': self.unsplit_moves,
+                'skip_rate': (float(self.unsplit_moves) / self.mesh_moves
+                              if self.mesh_moves else 0.)
+            }
+        return status
     def update_status(self):
         self.status = {
             "profile_name": "",
@@ -227,19 +447,35 @@ class BedMesh:
             "mesh_max": (0., 0.),
             "probed_matrix": [[]],
             "mesh_matrix": [[]],
-            "profiles": self.pmgr.get_profiles()
+            "mesh_cache": self.pmgr.get_mesh_cache_status(),
+            "mesh_swap": self.get_swap_status()
         }
-        if self.z_mesh is not None:
+        if self.z_mesh is None:
+            self.status_matrices = None
+        else:
             params = self.z_mesh.get_mesh_params()
             mesh_min = (params['min_x'], params['min_y'])
             mesh_max = (params['max_x'], params['max_y'])
-            probed_matrix = self.z_mesh.get_probed_matrix()
-            mesh_matrix = self.z_mesh.get_mesh_matrix()
+            probed_matrix, mesh_matrix = self._get_status_matrices(
+                self.z_mesh)
             self.status['profile_name'] = self.pmgr.get_current_profile()
             self.status['mesh_min'] = mesh_min
             self.status['mesh_max'] = mesh_max
             self.status['probed_matrix'] = probed_matrix
             self.status['mesh_matrix'] = mesh_matrix
+    def _get_status_matrices(self, z_mesh):
+        # Rounding the matrices costs more than the rest of the status,
+        # the result is kept until the active mesh or its matrices
+        # change.  Only the active mesh has rounded copies, the meshes of
+        # the mesh cache don't hold any.
+        key = (z_mesh, z_mesh.probed_matrix, z_mesh.mesh_matrix,
+               z_mesh.get_tilt_plane())
+        memo = self.status_matrices
+        if memo is None or [k for k, m in zip(key, memo[0]) if k is not m]:
+            memo = (key, z_mesh.get_probed_matrix(),
+                    z_mesh.get_mesh_matrix())
+            self.status_matrices = memo
+        return memo[1], memo[2]
     def get_mesh(self):
         return self.z_mesh
     cmd_BED_MESH_OUTPUT_help = "Retrieve interpolated grid of probed z-points"
@@ -277,6 +513,14 @@ class BedMesh:
             gcode_move.reset_last_position()
         else:
             gcmd.respond_info("No mesh loaded to offset")
+    cmd_BED_MESH_PERF_RESET_help = "Reset the bed_mesh timing counters"
+    def cmd_BED_MESH_PERF_RESET(self, gcmd):
+        if self.perf is None:
+            gcmd.respond_info(
+                "bed_mesh: perf_counters is not enabled in [bed_mesh]")
+            return
+        self.perf.reset()
+        self.mesh_moves = self.unsplit_moves = 0
 
 
 class BedMeshCalibrate:
@@ -716,7 +960,7 @@ class BedMeshCalibrate:
                         "Probed table length: %d Probed Table:\n%s") %
                     (len(probed_matrix), str(probed_matrix)))
 
-        z_mesh = ZMesh(params)
+        z_mesh = ZMesh(params, self.bedmesh.vectorized_sampling)
         try:
             z_mesh.build_mesh(probed_matrix)
         except BedMeshError as e:
@@ -744,12 +988,33 @@ class BedMeshCalibrate:
                 "  %-4d| %-17s| %-25s| %s" % (i, gen_pt, probed_pt, corr_pt))
 
 
+# Real roots of a + b*t + c*t^2 = 0
+def solve_quadratic(a, b, c):
+    if c == 0.:
+        if b == 0.:
+            return ()
+        return (-a / b,)
+    disc = b*b - 4.*a*c
+    if disc < 0.:
+        return ()
+    q = -.5 * (b + math.copysign(math.sqrt(disc), b))
+    if q == 0.:
+        return (0.,)
+    return (q / c, a / q)
+
+
 class MoveSplitter:
+    SPLIT_MODES = {'distance': 'distance', 'cell': 'cell'}
     def __init__(self, config, gcode):
         self.split_delta_z = config.getfloat(
             'split_delta_z', .025, minval=0.01)
         self.move_check_distance = config.getfloat(
             'move_check_distance', 5., minval=3.)
+        # 'distance' samples the mesh every move_check_distance, 'cell'
+        # calculates where the move crosses split_delta_z from the mesh
+        # cells it passes through
+        self.split_mode = config.getchoice(
+            'split_mode', self.SPLIT_MODES, 'distance')
         self.z_mesh = None
         self.fade_offset = 0.
         self.gcode = gcode
@@ -767,6 +1032,41 @@ class MoveSplitter:
         axes_d = [self.next_pos[i] - self.prev_pos[i] for i in range(4)]
         self.total_move_length = math.sqrt(sum([d*d for d in axes_d[:3]]))
         self.axis_move = [not isclose(d, 0., abs_tol=1e-10) for d in axes_d]
+        self.cell_splits = []
+        self.next_split = 0
+        if self.split_mode == 'cell' and (self.axis_move[0] or
+                                          self.axis_move[1]):
+            self.cell_splits = self._calc_cell_splits()
+    def _calc_cell_splits(self):
+        # Within a mesh cell the z offset along the move is a quadratic
+        # of the move ratio t.  Solve for the points where it reaches
+        # split_delta_z from the last split.
+        splits = []
+        factor = self.z_factor
+        fade_offset = self.fade_offset
+        delta = self.split_delta_z
+        z_offset = self.z_offset
+        t = 0.
+        segments = self.z_mesh.get_line_segments(
+            self.prev_pos[0], self.prev_pos[1],
+            self.next_pos[0], self.next_pos[1])
+        for t_start, t_end, a, b, c in segments:
+            a = factor * (a - fade_offset) + fade_offset
+            b *= factor
+            c *= factor
+            t_end = min(t_end, 1.)
+            while True:
+                t_next = None
+                for target in (z_offset + delta, z_offset - delta):
+                    for root in solve_quadratic(a - target, b, c):
+                        if (t < root < t_end and root >= t_start
+                                and (t_next is None or root < t_next[0])):
+                            t_next = (root, target)
+                if t_next is None:
+                    break
+                t, z_offset = t_next
+                splits.append(t_next)
+        return splits
     def _calc_z_offset(self, pos):
         z = self.z_mesh.calc_z(pos[0], pos[1])
         offset = self.fade_offset
@@ -777,13 +1077,24 @@ class MoveSplitter:
             raise self.gcode.error(
                 "bed_mesh: Slice distance is negative "
                 "or greater than entire move length")
+        self._set_move_ratio(t)
+    def _set_move_ratio(self, t):
         for i in range(4):
             if self.axis_move[i]:
                 self.current_pos[i] = lerp(
                     t, self.prev_pos[i], self.next_pos[i])
     def split(self):
         if not self.traverse_complete:
-            if self.axis_move[0] or self.axis_move[1]:
+            if self.next_split < len(self.cell_splits):
+                # split points precalculated from the mesh cells
+                t, self.z_offset = self.cell_splits[self.next_split]
+                self.next_split += 1
+                self._set_move_ratio(t)
+                return self.current_pos[0], self.current_pos[1], \
+                    self.current_pos[2] + self.z_offset, \
+                    self.current_pos[3]
+            elif self.split_mode == 'distance' and (self.axis_move[0] or
+                                                    self.axis_move[1]):
                 # X and/or Y axis move, traverse if necessary
                 while self.distance_checked + self.move_check_distance \
                         < self.total_move_length:
@@ -809,11 +1120,23 @@ class MoveSplitter:
 
 
 class ZMesh:
-    def __init__(self, params):
+    def __init__(self, params, vectorized=True):
         self.probed_matrix = self.mesh_matrix = None
+        # flat list of per cell bilinear coefficients used by calc_z
+        self.cell_coeffs = None
+        # the same coefficients as an array of cells, used by calc_z_batch
+        self.cell_coeff_array = None
+        # per cell z range (flat list) and min/max arrays used to find
+        # the moves that don't need splitting
+        self.cell_z_ranges = self.cell_z_range_array = None
+        self.cell_z_min = self.cell_z_max = None
         self.mesh_params = params
+        # mean of the mesh matrix without the tilt plane
+        self.mesh_avg = 0.
         self.avg_z = 0.
         self.mesh_offsets = [0., 0.]
+        # (a, b, c) of a plane z = a*x + b*y + c added to the mesh
+        self.tilt_plane = None
         logging.debug('bed_mesh: probe/mesh parameters:')
         for key, value in self.mesh_params.items():
             logging.debug("%s :  %s" % (key, value))
@@ -831,6 +1154,9 @@ class ZMesh:
             'bicubic': self._sample_bicubic,
             'direct': self._sample_direct
         }
+        if vectorized:
+            interpolation_algos['lagrange'] = self._sample_lagrange_vec
+            interpolation_algos['bicubic'] = self._sample_bicubic_vec
         self._sample = interpolation_algos.get(params['algo'])
         # Number of points to interpolate per segment
         mesh_x_pps = params['mesh_x_pps']
@@ -847,22 +1173,53 @@ class ZMesh:
                            (self.mesh_x_count - 1)
         self.mesh_y_dist = (self.mesh_y_max - self.mesh_y_min) / \
                            (self.mesh_y_count - 1)
+        self.cell_x_count = self.mesh_x_count - 1
+        self.max_cell_x = self.mesh_x_count - 2
+        self.max_cell_y = self.mesh_y_count - 2
+    def _add_tilt(self, matrix):
+        # The matrix (probed or interpolated) with the tilt plane added at
+        # its grid points, as a list like the matrix
+        if self.tilt_plane is None:
+            return matrix
+        a, b, c = self.tilt_plane
+        m = np.asarray(matrix, dtype=float)
+        xs = np.linspace(self.mesh_x_min, self.mesh_x_max, m.shape[1])
+        ys = np.linspace(self.mesh_y_min, self.mesh_y_max, m.shape[0])
+        return (m + (a * xs + c) + b * ys[:, np.newaxis]).tolist()
     def get_mesh_matrix(self):
         if self.mesh_matrix is not None:
             return [[round(z, 6) for z in line]
-                    for line in self.mesh_matrix]
+                    for line in self._add_tilt(self.mesh_matrix)]
         return [[]]
     def get_probed_matrix(self):
         if self.probed_matrix is not None:
             return [[round(z, 6) for z in line]
-                    for line in self.probed_matrix]
+                    for line in self._add_tilt(self.probed_matrix)]
         return [[]]
     def get_mesh_params(self):
         return self.mesh_params
+    def get_memory_usage(self):
+        # Rough estimate of the memory held by the probed and
+        # interpolated matrices (list slot + float object per value)
+        size = 0
+        matrices = [self.probed_matrix]
+        if self.mesh_matrix is not self.probed_matrix:
+            matrices.append(self.mesh_matrix)
+        for matrix in matrices:
+            if matrix is not None:
+                size += sum([len(line) for line in matrix]) * 32
+        if self.cell_coeffs is not None:
+            size += len(self.cell_coeffs) * 32
+            size += self.cell_coeff_array.nbytes
+        if self.cell_z_ranges is not None:
+            size += len(self.cell_z_ranges) * 32
+            size += self.cell_z_min.nbytes + self.cell_z_max.nbytes
+            size += self.cell_z_range_array.nbytes
+        return size
     def print_probed_matrix(self, print_func):
         if self.probed_matrix is not None:
             msg = "Mesh Leveling Probed Z positions:\n"
-            for line in self.probed_matrix:
+            for line in self._add_tilt(self.probed_matrix):
                 for x in line:
                     msg += " %f" % x
                 msg += "\n"
@@ -893,57 +1250,282 @@ class ZMesh:
     def build_mesh(self, z_matrix):
         self.probed_matrix = z_matrix
         self._sample(z_matrix)
-        self.avg_z = (sum([sum(x) for x in self.mesh_matrix]) /
-                      sum([len(x) for x in self.mesh_matrix]))
-        # Round average to the nearest 100th.  This
-        # should produce an offset that is divisible by common
-        # z step distances
-        self.avg_z = round(self.avg_z, 2)
-        self.print_mesh(logging.debug)
+        coeffs = self.calc_cell_coeffs(self.mesh_matrix)
+        self.cell_coeffs = coeffs.tolist()
+        self.cell_coeff_array = coeffs.reshape(-1, 4)
+        self.build_flatness_index(self.mesh_matrix)
+        self.mesh_avg = (sum([sum(x) for x in self.mesh_matrix]) /
+                         sum([len(x) for x in self.mesh_matrix]))
+        self._update_avg_z()
+        # formatting the whole mesh costs more than sampling it
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            self.print_mesh(logging.debug)
     def set_mesh_offsets(self, offsets):
         for i, o in enumerate(offsets):
             if o is not None:
                 self.mesh_offsets[i] = o
+    def _update_avg_z(self):
+        avg_z = self.mesh_avg
+        tilt = self.tilt_plane
+        if tilt is not None:
+            # the mean of the plane over the grid is its value in the
+            # middle of the mesh
+            avg_z += (tilt[0] * .5 * (self.mesh_x_min + self.mesh_x_max)
+                      + tilt[1] * .5 * (self.mesh_y_min + self.mesh_y_max)
+                      + tilt[2])
+        # Round average to the nearest 100th.  This
+        # should produce an offset that is divisible by common
+        # z step distances
+        self.avg_z = round(avg_z, 2)
+    def set_tilt_plane(self, tilt_plane):
+        self.tilt_plane = tilt_plane
+        self._update_avg_z()
+    def copy(self):
+        # Shallow copy sharing the built matrices, without the offsets
+        # and tilt plane
+        z_mesh = copy.copy(self)
+        z_mesh.mesh_offsets = [0., 0.]
+        z_mesh.set_tilt_plane(None)
+        return z_mesh
+    def get_tilt_plane(self):
+        return self.tilt_plane
     def get_x_coordinate(self, index):
         return self.mesh_x_min + self.mesh_x_dist * index
     def get_y_coordinate(self, index):
         return self.mesh_y_min + self.mesh_y_dist * index
     def calc_z(self, x, y):
-        if self.mesh_matrix is not None:
-            tbl = self.mesh_matrix
-            tx, xidx = self._get_linear_index(x + self.mesh_offsets[0], 0)
-            ty, yidx = self._get_linear_index(y + self.mesh_offsets[1], 1)
-            z0 = lerp(tx, tbl[yidx][xidx], tbl[yidx][xidx+1])
-            z1 = lerp(tx, tbl[yidx+1][xidx], tbl[yidx+1][xidx+1])
-            return lerp(ty, z0, z1)
-        else:
+        coeffs = self.cell_coeffs
+        if coeffs is None:
             # No mesh table generated, no z-adjustment
             return 0.
+        x += self.mesh_offsets[0]
+        y += self.mesh_offsets[1]
+        # Index and position of the point within its cell, points
+        # outside of the mesh are clamped to the edge cells
+        tx = (x - self.mesh_x_min) / self.mesh_x_dist
+        xidx = int(math.floor(tx))
+        if xidx < 0:
+            xidx = 0
+        elif xidx > self.max_cell_x:
+            xidx = self.max_cell_x
+        tx -= xidx
+        if tx < 0.:
+            tx = 0.
+        elif tx > 1.:
+            tx = 1.
+        ty = (y - self.mesh_y_min) / self.mesh_y_dist
+        yidx = int(math.floor(ty))
+        if yidx < 0:
+            yidx = 0
+        elif yidx > self.max_cell_y:
+            yidx = self.max_cell_y
+        ty -= yidx
+        if ty < 0.:
+            ty = 0.
+        elif ty > 1.:
+            ty = 1.
+        i = 4 * (yidx * self.cell_x_count + xidx)
+        z = coeffs[i] + coeffs[i+1] * tx + (coeffs[i+2] + coeffs[i+3] * tx) * ty
+        tilt = self.tilt_plane
+        if tilt is not None:
+            # the plane is clamped to the mesh edge like the mesh
+            x = self.mesh_x_min + (xidx + tx) * self.mesh_x_dist
+            y = self.mesh_y_min + (yidx + ty) * self.mesh_y_dist
+            z += tilt[0] * x + tilt[1] * y + tilt[2]
+        return z
+    def build_flatness_index(self, mesh):
+        # A bilinear cell lies between its lowest and highest corner
+        mesh = np.asarray(mesh, dtype=float)
+        corners = [mesh[:-1, :-1], mesh[:-1, 1:], mesh[1:, :-1], mesh[1:, 1:]]
+        self.cell_z_min = np.minimum.reduce(corners)
+        self.cell_z_max = np.maximum.reduce(corners)
+        self.cell_z_range_array = (self.cell_z_max - self.cell_z_min).ravel()
+        self.cell_z_ranges = self.cell_z_range_array.tolist()
+    def _get_cell_index(self, coord, mesh_min, mesh_dist, max_cell):
+        idx = int(math.floor((coord - mesh_min) / mesh_dist))
+        if idx < 0:
+            return 0
+        elif idx > max_cell:
+            return max_cell
+        return idx
+    def get_move_z_range(self, x0, y0, x1, y1):
+        # Upper bound of the z change along the line from (x0, y0) to
+        # (x1, y1): the z range of the box of cells it crosses plus the
+        # change of the tilt plane along the line
+        if self.cell_z_ranges is None:
+            return 0.
+        x_off, y_off = self.mesh_offsets
+        xa = self._get_cell_index(x0 + x_off, self.mesh_x_min,
+                                  self.mesh_x_dist, self.max_cell_x)
+        xb = self._get_cell_index(x1 + x_off, self.mesh_x_min,
+                                  self.mesh_x_dist, self.max_cell_x)
+        ya = self._get_cell_index(y0 + y_off, self.mesh_y_min,
+                                  self.mesh_y_dist, self.max_cell_y)
+        yb = self._get_cell_index(y1 + y_off, self.mesh_y_min,
+                                  self.mesh_y_dist, self.max_cell_y)
+        if xa == xb and ya == yb:
+            z_range = self.cell_z_ranges[ya * self.cell_x_count + xa]
+        else:
+            if xa > xb:
+                xa, xb = xb, xa
+            if ya > yb:
+                ya, yb = yb, ya
+            z_range = float(self.cell_z_max[ya:yb+1, xa:xb+1].max()
+                            - self.cell_z_min[ya:yb+1, xa:xb+1].min())
+        tilt = self.tilt_plane
+        if tilt is not None:
+            # calc_z clamps the plane at the mesh edge, a move leaving the
+            # mesh follows a bent line on the plane
+            x0 += x_off
+            x1 += x_off
+            y0 += y_off
+            y1 += y_off
+            cx0 = constrain(x0, self.mesh_x_min, self.mesh_x_max)
+            cx1 = constrain(x1, self.mesh_x_min, self.mesh_x_max)
+            cy0 = constrain(y0, self.mesh_y_min, self.mesh_y_max)
+            cy1 = constrain(y1, self.mesh_y_min, self.mesh_y_max)
+            if cx0 == x0 and cx1 == x1 and cy0 == y0 and cy1 == y1:
+                z_range += abs(tilt[0] * (x1 - x0) + tilt[1] * (y1 - y0))
+            else:
+                z_range += (abs(tilt[0] * (cx1 - cx0))
+                            + abs(tilt[1] * (cy1 - cy0)))
+        return z_range
+    def _get_cell_indices(self, x, y):
+        # Cell index and position within the cell of arrays of points,
+        # same as calc_z.  x and y are returned clamped to the mesh.
+        x = np.asarray(x, dtype=float) + self.mesh_offsets[0]
+        y = np.asarray(y, dtype=float) + self.mesh_offsets[1]
+        tx = (x - self.mesh_x_min) / self.mesh_x_dist
+        xidx = np.minimum(np.maximum(np.floor(tx), 0.), self.max_cell_x)
+        tx = np.minimum(np.maximum(tx - xidx, 0.), 1.)
+        ty = (y - self.mesh_y_min) / self.mesh_y_dist
+        yidx = np.minimum(np.maximum(np.floor(ty), 0.), self.max_cell_y)
+        ty = np.minimum(np.maximum(ty - yidx, 0.), 1.)
+        idx = (yidx * self.cell_x_count + xidx).astype(int)
+        x = self.mesh_x_min + (xidx + tx) * self.mesh_x_dist
+        y = self.mesh_y_min + (yidx + ty) * self.mesh_y_dist
+        return idx, tx, ty, x, y
+    def _calc_z_cells(self, idx, tx, ty, x, y):
+        c = self.cell_coeff_array[idx]
+        z = c[:, 0] + c[:, 1] * tx + (c[:, 2] + c[:, 3] * tx) * ty
+        tilt = self.tilt_plane
+        if tilt is not None:
+            z += tilt[0] * x + tilt[1] * y + tilt[2]
+        return z
+    def calc_z_batch(self, x, y):
+        # calc_z of arrays of points
+        if self.cell_coeff_array is None:
+            return np.zeros(np.shape(x))
+        return self._calc_z_cells(*self._get_cell_indices(x, y))
+    def calc_path(self, x, y):
+        # calc_z of the points of a path and get_move_z_range of each of
+        # its moves, moves crossing more than one cell get an infinite
+        # range
+        if self.cell_coeff_array is None:
+            return np.zeros(np.shape(x)), np.zeros(len(x) - 1)
+        cells = self._get_cell_indices(x, y)
+        idx = cells[0]
+        z_range = np.where(idx[:-1] == idx[1:],
+                           self.cell_z_range_array[idx[1:]], np.inf)
+        tilt = self.tilt_plane
+        if tilt is not None:
+            # Same bound as get_move_z_range
+            x = np.asarray(x, dtype=float) + self.mesh_offsets[0]
+            y = np.asarray(y, dtype=float) + self.mesh_offsets[1]
+            cx = np.clip(x, self.mesh_x_min, self.mesh_x_max)
+            cy = np.clip(y, self.mesh_y_min, self.mesh_y_max)
+            inside = (cx == x) & (cy == y)
+            dx = tilt[0] * (cx[1:] - cx[:-1])
+            dy = tilt[1] * (cy[1:] - cy[:-1])
+            z_range += np.where(inside[:-1] & inside[1:], np.abs(dx + dy),
+                                np.abs(dx) + np.abs(dy))
+        return self._calc_z_cells(*cells), z_range
+    def calc_cell_coeffs(self, matrix):
+        # Bilinear coefficients of every mesh cell, for a cell at
+        # (xidx, yidx) the four values starting at
+        # 4 * (yidx * (mesh_x_count - 1) + xidx) give
+        # z = c0 + c1*tx + (c2 + c3*tx)*ty.  matrix may be a stack of meshes.
+        m = np.asarray(matrix, dtype=float)
+        z00 = m[..., :-1, :-1]
+        z10 = m[..., :-1, 1:]
+        z01 = m[..., 1:, :-1]
+        z11 = m[..., 1:, 1:]
+        coeffs = np.stack(
+            (z00, z10 - z00, z01 - z00, z11 - z10 - z01 + z00), axis=-1)
+        return coeffs.reshape(m.shape[:-2] + (-1,))
+    def get_line_segments(self, x0, y0, x1, y1):
+        # Split the XY line into the pieces crossing a single mesh cell.
+        # Along a piece the bilinear Z is a quadratic of the line ratio t,
+        # returns a list of (t_start, t_end, a, b, c), z = a + b*t + c*t^2
+        coeffs = self.cell_coeffs
+        if coeffs is None:
+            return [(0., 1., 0., 0., 0.)]
+        x0 += self.mesh_offsets[0]
+        x1 += self.mesh_offsets[0]
+        y0 += self.mesh_offsets[1]
+        y1 += self.mesh_offsets[1]
+        breaks = set([0., 1.])
+        breaks.update(self._get_grid_crossings(x0, x1, 0))
+        breaks.update(self._get_grid_crossings(y0, y1, 1))
+        breaks = sorted(breaks)
+        tilt = self.tilt_plane
+        tilt_a = tilt_b = 0.
+        segments = []
+        for t_start, t_end in zip(breaks[:-1], breaks[1:]):
+            t_mid = .5 * (t_start + t_end)
+            xidx, u0, du = self._get_line_cell(x0, x1, t_mid, 0)
+            yidx, v0, dv = self._get_line_cell(y0, y1, t_mid, 1)
+            i = 4 * (yidx * self.cell_x_count + xidx)
+            z00, c1, c2, c3 = coeffs[i:i+4]
+            if tilt is not None:
+                # the tilt plane adds a linear term along the line, at
+                # the clamped cell coordinates like calc_z
+                cx = self.mesh_x_min + (xidx + u0) * self.mesh_x_dist
+                cy = self.mesh_y_min + (yidx + v0) * self.mesh_y_dist
+                tilt_a = tilt[0] * cx + tilt[1] * cy + tilt[2]
+                tilt_b = (tilt[0] * du * self.mesh_x_dist
+                          + tilt[1] * dv * self.mesh_y_dist)
+            segments.append((
+                t_start, t_end, z00 + c1*u0 + c2*v0 + c3*u0*v0 + tilt_a,
+                c1*du + c2*dv + c3*(u0*dv + v0*du) + tilt_b, c3*du*dv))
+        return segments
+    def _get_axis_params(self, axis):
+        if axis == 0:
+            return self.mesh_x_min, self.mesh_x_count, self.mesh_x_dist
+        return self.mesh_y_min, self.mesh_y_count, self.mesh_y_dist
+    def _get_grid_crossings(self, c0, c1, axis):
+        # Line ratios where the line crosses grid lines of an axis
+        mesh_min, mesh_cnt, mesh_dist = self._get_axis_params(axis)
+        delta = c1 - c0
+        if delta == 0.:
+            return []
+        lo = (min(c0, c1) - mesh_min) / mesh_dist
+        hi = (max(c0, c1) - mesh_min) / mesh_dist
+        first = max(int(math.ceil(lo)), 0)
+        last = min(int(math.floor(hi)), mesh_cnt - 1)
+        return [(mesh_min + i * mesh_dist - c0) / delta
+                for i in range(first, last + 1)]
+    def _get_line_cell(self, c0, c1, t, axis):
+        # Cell index and the local cell coordinate u = u0 + du*t along the
+        # line.  Outside of the mesh the coordinate is clamped like calc_z
+        mesh_min, mesh_cnt, mesh_dist = self._get_axis_params(axis)
+        coord = lerp(t, c0, c1)
+        idx = int(math.floor((coord - mesh_min) / mesh_dist))
+        idx = constrain(idx, 0, mesh_cnt - 2)
+        cell_min = mesh_min + idx * mesh_dist
+        if coord < cell_min:
+            return idx, 0., 0.
+        elif coord > cell_min + mesh_dist:
+            return idx, 1., 0.
+        return idx, (c0 - cell_min) / mesh_dist, (c1 - c0) / mesh_dist
     def get_z_range(self):
         if self.mesh_matrix is not None:
-            mesh_min = min([min(x) for x in self.mesh_matrix])
-            mesh_max = max([max(x) for x in self.mesh_matrix])
+            matrix = self._add_tilt(self.mesh_matrix)
+            mesh_min = min([min(x) for x in matrix])
+            mesh_max = max([max(x) for x in matrix])
             return mesh_min, mesh_max
         else:
             return 0., 0.
-    def _get_linear_index(self, coord, axis):
-        if axis == 0:
-            # X-axis
-            mesh_min = self.mesh_x_min
-            mesh_cnt = self.mesh_x_count
-            mesh_dist = self.mesh_x_dist
-            cfunc = self.get_x_coordinate
-        else:
-            # Y-axis
-            mesh_min = self.mesh_y_min
-            mesh_cnt = self.mesh_y_count
-            mesh_dist = self.mesh_y_dist
-            cfunc = self.get_y_coordinate
-        t = 0.
-        idx = int(math.floor((coord - mesh_min) / mesh_dist))
-        idx = constrain(idx, 0, mesh_cnt - 2)
-        t = (coord - cfunc(idx)) / mesh_dist
-        return constrain(t, 0., 1.), idx
     def _sample_direct(self, z_matrix):
         self.mesh_matrix = z_matrix
     def _sample_lagrange(self, z_matrix):
@@ -1096,17 +1678,315 @@ class ZMesh:
         c = m1 * (t3 - 2*t2 + t)
         d = m2 * (t3 - t2)
         return a + b + c + d
+    def _sample_lagrange_vec(self, z_matrix):
+        # Same result as _sample_lagrange, computed with one matrix
+        # product per axis
+        self.mesh_matrix = self.interpolate_lagrange(z_matrix).tolist()
+    def _sample_bicubic_vec(self, z_matrix):
+        # Same result as _sample_bicubic, all points of an axis are
+        # interpolated at once
+        self.mesh_matrix = self.interpolate_bicubic(z_matrix).tolist()
+    def interpolate_lagrange(self, z_matrix):
+        # z_matrix may hold a stack of probed matrices, the last two
+        # axes are Y and X
+        x_weights = lagrange_weights(
+            self.mesh_x_min, self.mesh_x_dist, self.mesh_x_count, self.x_mult)
+        y_weights = lagrange_weights(
+            self.mesh_y_min, self.mesh_y_dist, self.mesh_y_count, self.y_mult)
+        x_rows = np.matmul(np.asarray(z_matrix, dtype=float), x_weights.T)
+        return np.matmul(y_weights, x_rows)
+    def interpolate_bicubic(self, z_matrix):
+        # z_matrix may hold a stack of probed matrices, the last two
+        # axes are Y and X
+        c = self.mesh_params['tension']
+        z_matrix = np.asarray(z_matrix, dtype=float)
+        matrix = np.zeros(z_matrix.shape[:-2]
+                          + (self.mesh_y_count, self.mesh_x_count))
+        matrix[..., ::self.y_mult, ::self.x_mult] = z_matrix
+        # rows with probed points, a view into the matrix
+        x_rows = matrix[..., ::self.y_mult, :]
+        idx, p0, p1, p2, p3, t = spline_ctl_indices(
+            self.mesh_x_count, self.x_mult)
+        x_rows[..., idx] = self._cardinal_spline(
+            (x_rows[..., p0], x_rows[..., p1], x_rows[..., p2],
+             x_rows[..., p3], t), c)
+        idx, p0, p1, p2, p3, t = spline_ctl_indices(
+            self.mesh_y_count, self.y_mult)
+        t = t[:, None]
+        matrix[..., idx, :] = self._cardinal_spline(
+            (matrix[..., p0, :], matrix[..., p1, :], matrix[..., p2, :],
+             matrix[..., p3, :], t), c)
+        return matrix
+
+
+class ThermalMesh(ZMesh):
+    # Stack of meshes indexed by frame temperature.  Z is interpolated in
+    # x, y and temperature, changing the temperature only blends the two
+    # nearest layers, no profile is loaded.
+    def __init__(self, params):
+        ZMesh.__init__(self, params)
+        self.temps = self.probed_layers = self.mesh_layers = None
+        self.coeff_layers = None
+        self.temperature = None
+    def build_thermal_mesh(self, temps, z_matrices):
+        order = np.argsort(temps)
+        self.temps = np.asarray(temps, dtype=float)[order]
+        self.probed_layers = np.asarray(z_matrices, dtype=float)[order]
+        algo = self.mesh_params['algo']
+        if algo == 'lagrange':
+            self.mesh_layers = self.interpolate_lagrange(self.probed_layers)
+        elif algo == 'bicubic':
+            self.mesh_layers = self.interpolate_bicubic(self.probed_layers)
+        else:
+            self.mesh_layers = self.probed_layers
+        # the coefficients are linear in z, blending them is the same
+        # as rebuilding the table from the blended mesh
+        self.coeff_layers = self.calc_cell_coeffs(self.mesh_layers)
+        self.set_temperature(self.temps[0])
+    def _find_temperature(self, temp):
+        # Clamped temperature, the two nearest layers and the blend
+        # factor between them
+        temps = self.temps
+        temp = constrain(temp, temps[0], temps[-1])
+        idx = int(np.searchsorted(temps, temp, side='right')) - 1
+        idx = constrain(idx, 0, max(len(temps) - 2, 0))
+        next_idx = min(idx + 1, len(temps) - 1)
+        t = 0.
+        if next_idx != idx:
+            t = (temp - temps[idx]) / (temps[next_idx] - temps[idx])
+        return temp, idx, next_idx, t
+    def set_temperature(self, temp):
+        temp, idx, next_idx, t = self._find_temperature(temp)
+        mesh = lerp(t, self.mesh_layers[idx], self.mesh_layers[next_idx])
+        probed = lerp(
+            t, self.probed_layers[idx], self.probed_layers[next_idx])
+        coeffs = lerp(t, self.coeff_layers[idx], self.coeff_layers[next_idx])
+        self._set_layers(temp, mesh, probed, coeffs)
+    def _set_layers(self, temp, mesh, probed, coeffs):
+        self.cell_coeffs = coeffs.tolist()
+        self.cell_coeff_array = coeffs.reshape(-1, 4)
+        self.build_flatness_index(mesh)
+        self.mesh_matrix = mesh.tolist()
+        self.probed_matrix = probed.tolist()
+        self.mesh_avg = float(np.mean(mesh))
+        self._update_avg_z()
+        self.temperature = float(temp)
+    def get_temperature(self):
+        return self.temperature
+    def get_memory_usage(self):
+        size = ZMesh.get_memory_usage(self)
+        size += self.probed_layers.nbytes + self.coeff_layers.nbytes
+        if self.mesh_layers is not self.probed_layers:
+            size += self.mesh_layers.nbytes
+        return size
+
+
+class LowRankThermalMesh(ThermalMesh):
+    # Thermal mesh of a low rank model (generate_FDC_meshes_z_heights.py
+    # --thermal_model): a mean mesh plus a few basis meshes, weighted by
+    # coefficients per temperature.  The layers are the mean and basis
+    # meshes, a temperature is their weighted sum.
+    def __init__(self, params):
+        ThermalMesh.__init__(self, params)
+        self.weights = None
+    def build_low_rank_mesh(self, temps, mean, basis, weights):
+        order = np.argsort(temps)
+        self.temps = np.asarray(temps, dtype=float)[order]
+        self.weights = np.asarray(weights, dtype=float)[order]
+        self.probed_layers = np.concatenate(
+            ([mean], basis)).astype(float)
+        algo = self.mesh_params['algo']
+        if algo == 'lagrange':
+            self.mesh_layers = self.interpolate_lagrange(self.probed_layers)
+        elif algo == 'bicubic':
+            self.mesh_layers = self.interpolate_bicubic(self.probed_layers)
+        else:
+            self.mesh_layers = self.probed_layers
+        self.coeff_layers = self.calc_cell_coeffs(self.mesh_layers)
+        self.set_temperature(self.temps[0])
+    def set_temperature(self, temp):
+        temp, idx, next_idx, t = self._find_temperature(temp)
+        weights = np.concatenate(
+            ([1.], lerp(t, self.weights[idx], self.weights[next_idx])))
+        self._set_layers(temp, np.tensordot(weights, self.mesh_layers, 1),
+                         np.tensordot(weights, self.probed_layers, 1),
+                         np.tensordot(weights, self.coeff_layers, 1))
+    def get_memory_usage(self):
+        return ThermalMesh.get_memory_usage(self) + self.weights.nbytes
+
+
+class ZMeshCache:
+    # LRU cache of fully built meshes, keyed by profile name and
+    # mesh parameters.  Bounded by entry count and estimated memory.
+    def __init__(self, max_entries, max_memory):
+        self.max_entries = max_entries
+        self.max_memory = max_memory
+        self.entries = collections.OrderedDict()
+        self.memory = 0
+        self.hits = self.misses = 0
+    def _make_key(self, prof_name, mesh_params):
+        return (prof_name, tuple(mesh_params.items()))
+    def get(self, prof_name, mesh_params):
+        key = self._make_key(prof_name, mesh_params)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+    def put(self, prof_name, mesh_params, z_mesh):
+        if not self.max_entries:
+            return
+        size = z_mesh.get_memory_usage()
+        if size > self.max_memory:
+            return
+        key = self._make_key(prof_name, mesh_params)
+        self._remove_key(key)
+        self.entries[key] = (z_mesh, size)
+        self.memory += size
+        while (len(self.entries) > self.max_entries
+               or self.memory > self.max_memory):
+            self._remove_key(next(iter(self.entries)))
+    def _remove_key(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.memory -= entry[1]
+    def invalidate(self, prof_name):
+        for key in [k for k in self.entries if k[0] == prof_name]:
+            self._remove_key(key)
+    def get_status(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self.entries),
+            'memory': self.memory
+        }
+
+
+class ProfileStore:
+    # Profiles kept outside of printer.cfg, written by
+    # generate_FDC_meshes_z_heights.py --profile_store.  The points of
+    # all profiles are a single float32 .npy array, memory mapped, and
+    # the json index maps each profile to its offset in the array and
+    # its entry in the list of mesh parameters.
+    def __init__(self, filename):
+        with open(filename, 'r') as f:
+            index = json.load(f)
+        self.version = index['version']
+        self.entries = index['profiles']
+        self.mesh_params = index['mesh_params']
+        data_file = os.path.join(os.path.dirname(filename), index['data'])
+        self.data = np.load(data_file, mmap_mode='r')
+    def get_names(self):
+        return list(self.entries)
+    def get_mesh_params(self, name):
+        stored_params = self.mesh_params[self.entries[name][1]]
+        params = collections.OrderedDict()
+        for key, t in PROFILE_OPTIONS.items():
+            params[key] = t(stored_params[key])
+        return params
+    def get_points(self, name, params):
+        offset = self.entries[name][0]
+        x_cnt = params['x_count']
+        y_cnt = params['y_count']
+        points = self.data[offset:offset + x_cnt * y_cnt].reshape(
+            y_cnt, x_cnt)
+        # float32 keeps 7 significant digits, rounding restores the
+        # 6 decimals profiles are saved with
+        return [[round(z, 6) for z in line] for line in points.tolist()]
+
+
+class PerfCounters:
+    # Call count, cumulative and max time of wrapped methods
+    def __init__(self):
+        self.counters = collections.OrderedDict()
+    def wrap(self, obj, method_name, name=None):
+        # Replace the bound method by a timed one on this object only
+        if name is None:
+            name = method_name
+        counter = self.counters.setdefault(name, [0, 0., 0.])
+        func = getattr(obj, method_name)
+        timer = time.perf_counter
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = timer()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = timer() - start
+                counter[0] += 1
+                counter[1] += elapsed
+                if elapsed > counter[2]:
+                    counter[2] = elapsed
+        setattr(obj, method_name, timed)
+    def reset(self):
+        for counter in self.counters.values():
+            counter[:] = [0, 0., 0.]
+    def get_status(self):
+        status = {}
+        for name, (count, total_time, max_time) in self.counters.items():
+            status[name] = {
+                'count': count,
+                'total_time': total_time,
+                'avg_time': total_time / count if count else 0.,
+                'max_time': max_time
+            }
+        moves = self.counters.get('move', [0])[0]
+        splits = self.counters.get('split', [0])[0]
+        status['splits_per_move'] = float(splits) / moves if moves else 0.
+        return status
 
 
 class ProfileManager:
+    # 'full' reports the points of every profile in the status (stock
+    # behavior) and keeps them all in memory once the status is requested,
+    # 'names' only the mesh parameters
+    STATUS_MODES = {'full': 'full', 'names': 'names'}
     def __init__(self, config, bedmesh):
         self.name = config.get_name()
         self.printer = config.get_printer()
         self.gcode = self.printer.lookup_object('gcode')
         self.bedmesh = bedmesh
-        self.profiles = {}
+        # Stored profiles are indexed by name at startup, their points and
+        # mesh parameters are only parsed when used (FDC stores thousands
+        # of them).  Parsed profiles are kept in a bounded LRU.
+        self.stored_profiles = {}
+        self.parsed_profiles = collections.OrderedDict()
+        self.profile_cache_size = config.getint(
+            'profile_cache_size', 64, minval=1)
+        self.status_profiles = None
+        self.status_params = {}
+        self.profile_status = config.getchoice(
+            'profile_status', self.STATUS_MODES, 'full')
         self.current_profile = ""
         self.incompatible_profiles = []
+        self.thermal_mesh = None
+        # Cache of built meshes, FDC reloads the same profiles repeatedly
+        self.mesh_cache = ZMeshCache(
+            config.getint('mesh_cache_size', 16, minval=0),
+            config.getint('mesh_cache_memory', 4096, minval=0) * 1024)
+        # Profiles of the external store, [bed_mesh <name>] sections of
+        # the same name take precedence
+        self.profile_store = None
+        store_file = self._get_path(config, 'profile_store')
+        if store_file is not None:
+            try:
+                self.profile_store = ProfileStore(store_file)
+            except (IOError, OSError, ValueError, KeyError) as e:
+                raise config.error(
+                    "bed_mesh: Unable to open profile store %s: %s"
+                    % (store_file, str(e)))
+            if self.profile_store.version != PROFILE_VERSION:
+                raise config.error(
+                    "bed_mesh: Profile store %s not compatible with this "
+                    "version of bed_mesh.  Store Version: %s Current "
+                    "Version: %d" % (store_file, self.profile_store.version,
+                                     PROFILE_VERSION))
+            for name in self.profile_store.get_names():
+                self.stored_profiles[name] = self.profile_store
+        # Low rank thermal model used by THERMAL instead of the profiles
+        self.thermal_model = self._get_path(config, 'thermal_model')
         # Fetch stored profiles from Config
         stored_profs = config.get_prefix_sections(self.name)
         stored_profs = [s for s in stored_profs
@@ -1121,31 +2001,119 @@ class ProfileManager:
                     % (name, version, PROFILE_VERSION))
                 self.incompatible_profiles.append(name)
                 continue
-            self.profiles[name] = {}
-            zvals = profile.getlists('points', seps=(',', '\n'), parser=float)
-            self.profiles[name]['points'] = zvals
-            self.profiles[name]['mesh_params'] = params = \
-                collections.OrderedDict()
-            for key, t in PROFILE_OPTIONS.items():
-                if t is int:
-                    params[key] = profile.getint(key)
-                elif t is float:
-                    params[key] = profile.getfloat(key)
-                elif t is str:
-                    params[key] = profile.get(key)
+            raw = {'points': profile.get('points')}
+            for key in PROFILE_OPTIONS:
+                raw[key] = profile.get(key)
+            self.stored_profiles[name] = raw
         # todo: take z_postions from z_tilt
         # added for tilt
         self.z_positions = config.getlists('z_positions', seps=(',', '\n'),
                                            parser=float, count=2)
-        if len(self.z_positions) != 3:
+        if len(self.z_positions) < 3:
             raise self.gcode.error(
-                "bed_mesh with tilt:  z_tilt z_positions not specified or the number of steppers are unsupported [%s]" % self.z_positions)
+                "bed_mesh with tilt:  z_tilt/quad_gantry_level z_positions not specified or less than 3 steppers [%s]" % (self.z_positions,))
+        # Least squares fit of the plane z = a*x + b*y + c to the stepper
+        # positions.  The pseudo-inverse only depends on z_positions, a
+        # tilt is then a single matrix-vector product.
+        z_pos_matrix = np.array([[x, y, 1.] for x, y in self.z_positions])
+        self.tilt_projection = np.linalg.pinv(z_pos_matrix)
         # Register GCode
         self.gcode.register_command(
             'BED_MESH_PROFILE', self.cmd_BED_MESH_PROFILE,
             desc=self.cmd_BED_MESH_PROFILE_help)
+        webhooks = self.printer.lookup_object('webhooks')
+        webhooks.register_endpoint(
+            "bed_mesh/profile", self._handle_profile_request)
+    def _get_path(self, config, option):
+        # Optional file, relative to the printer.cfg folder
+        filename = config.get(option, None)
+        if filename is None:
+            return None
+        filename = os.path.expanduser(filename)
+        if not os.path.isabs(filename):
+            config_file = self.printer.get_start_args()['config_file']
+            filename = os.path.join(os.path.dirname(config_file), filename)
+        return filename
     def get_profiles(self):
-        return self.profiles
+        # Status view of all profiles, parsed on the first request
+        if self.status_profiles is None:
+            self.status_profiles = dict(
+                [(name, self._get_status_profile(name))
+                 for name in self.stored_profiles])
+        return self.status_profiles
+    def _get_status_profile(self, prof_name):
+        if self.profile_status == 'names':
+            # FDC profiles share their mesh parameters, keep one copy
+            params = self.get_profile_params(prof_name)
+            key = tuple(sorted(params.items()))
+            return {'mesh_params': self.status_params.setdefault(key, params)}
+        return self.get_profile(prof_name, cache=False)
+    def get_profile_params(self, prof_name):
+        profile = self.parsed_profiles.get(prof_name)
+        if profile is not None:
+            return profile['mesh_params']
+        return self._parse_profile(
+            prof_name, self._get_stored_profile(prof_name),
+            with_points=False)['mesh_params']
+    def _get_stored_profile(self, prof_name):
+        raw = self.stored_profiles.get(prof_name)
+        if raw is None:
+            raise self.gcode.error(
+                "bed_mesh: Unknown profile [%s]" % prof_name)
+        return raw
+    def get_profile_names(self):
+        return list(self.stored_profiles)
+    def get_profile(self, prof_name, cache=True):
+        profile = self.parsed_profiles.get(prof_name)
+        if profile is not None:
+            if cache:
+                self.parsed_profiles.move_to_end(prof_name)
+            return profile
+        raw = self._get_stored_profile(prof_name)
+        profile = self._parse_profile(prof_name, raw)
+        if cache:
+            self.parsed_profiles[prof_name] = profile
+            while len(self.parsed_profiles) > self.profile_cache_size:
+                self.parsed_profiles.popitem(last=False)
+        return profile
+    def _parse_profile(self, prof_name, raw, with_points=True):
+        store = self.profile_store
+        try:
+            if raw is store:
+                params = store.get_mesh_params(prof_name)
+            else:
+                params = collections.OrderedDict()
+                for key, t in PROFILE_OPTIONS.items():
+                    params[key] = t(raw[key])
+            if not with_points:
+                return {'mesh_params': params}
+            if raw is store:
+                points = store.get_points(prof_name, params)
+            else:
+                points = [[float(p) for p in line.split(',')]
+                          for line in raw['points'].split('\n')
+                          if line.strip()]
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            raise self.gcode.error(
+                "bed_mesh: Unable to parse profile [%s]: %s"
+                % (prof_name, str(e)))
+        return {'points': points, 'mesh_params': params}
+    def _update_profile(self, prof_name, raw):
+        # Replace (or remove, raw=None) a stored profile.  A status view
+        # already returned is not modified.
+        if raw is None:
+            del self.stored_profiles[prof_name]
+        else:
+            self.stored_profiles[prof_name] = raw
+        self.parsed_profiles.pop(prof_name, None)
+        if self.status_profiles is not None:
+            profiles = dict(self.status_profiles)
+            profiles.pop(prof_name, None)
+            if raw is not None:
+                profiles[prof_name] = self._get_status_profile(prof_name)
+            self.status_profiles = profiles
+        self.mesh_cache.invalidate(prof_name)
+        self.thermal_mesh = None
     def get_current_profile(self):
         return self.current_profile
     def _check_incompatible_profiles(self):
@@ -1179,15 +2147,12 @@ class ProfileManager:
             z_values = z_values[:-2]
         configfile.set(cfg_name, 'version', PROFILE_VERSION)
         configfile.set(cfg_name, 'points', z_values)
+        raw = {'points': z_values}
         for key, value in mesh_params.items():
             configfile.set(cfg_name, key, value)
+            raw[key] = str(value)
         # save copy in local storage
-        # ensure any self.profiles returned as status remains immutable
-        profiles = dict(self.profiles)
-        profiles[prof_name] = profile = {}
-        profile['points'] = probed_matrix
-        profile['mesh_params'] = collections.OrderedDict(mesh_params)
-        self.profiles = profiles
+        self._update_profile(prof_name, raw)
         self.current_profile = prof_name
         self.bedmesh.update_status()
         self.gcode.respond_info(
@@ -1195,27 +2160,147 @@ class ProfileManager:
             "for the current session.  The SAVE_CONFIG command will\n"
             "update the printer config file and restart the printer."
             % (prof_name))
-    def load_profile(self, prof_name):
-        profile = self.profiles.get(prof_name, None)
-        if profile is None:
-            raise self.gcode.error(
-                "bed_mesh: Unknown profile [%s]" % prof_name)
+    def get_mesh_cache_status(self):
+        return self.mesh_cache.get_status()
+    def _get_z_mesh(self, prof_name):
+        profile = self.get_profile(prof_name)
         probed_matrix = profile['points']
         mesh_params = profile['mesh_params']
-        z_mesh = ZMesh(mesh_params)
+        z_mesh = self.mesh_cache.get(prof_name, mesh_params)
+        if z_mesh is not None:
+            # offsets set by BED_MESH_OFFSET and tilt do not persist
+            # across loads.  The cached mesh may be the active one, a
+            # copy keeps it unchanged until the new mesh is published.
+            return z_mesh.copy()
+        z_mesh = ZMesh(mesh_params, self.bedmesh.vectorized_sampling)
+        if self.bedmesh.perf is not None:
+            self.bedmesh.perf.wrap(z_mesh, 'build_mesh')
         try:
             z_mesh.build_mesh(probed_matrix)
         except BedMeshError as e:
             raise self.gcode.error(str(e))
+        self.mesh_cache.put(prof_name, mesh_params, z_mesh)
+        return z_mesh.copy()
+    def load_profile(self, prof_name, deferred=False):
+        if deferred:
+            self.load_profile_deferred(prof_name)
+            return
+        z_mesh = self._get_z_mesh(prof_name)
         self.current_profile = prof_name
         self.bedmesh.set_mesh(z_mesh)
+    def load_profile_deferred(self, prof_name):
+        # Build the mesh from a reactor callback, the gcode stream isn't
+        # held while interpolating and the mesh is swapped on the next move
+        reactor = self.printer.get_reactor()
+        request_time = reactor.monotonic()
+        generation = self.bedmesh.request_mesh()
+        def prepare(eventtime):
+            if generation != self.bedmesh.mesh_generation:
+                # Replaced by a later request (LOAD, BED_MESH_CLEAR, ...)
+                # before the callback ran
+                return
+            try:
+                z_mesh = self._get_z_mesh(prof_name)
+                self.bedmesh.queue_mesh(z_mesh, prof_name, request_time,
+                                        generation)
+            except self.gcode.error as e:
+                self.gcode.respond_info(
+                    "bed_mesh: Unable to load profile [%s]: %s"
+                    % (prof_name, str(e)))
+        reactor.register_callback(prepare)
+    def _build_low_rank_mesh(self):
+        try:
+            with np.load(self.thermal_model, allow_pickle=False) as model:
+                version = int(model['version'])
+                if version != PROFILE_VERSION:
+                    raise self.gcode.error(
+                        "bed_mesh: Thermal model version %d not compatible "
+                        "with this version of bed_mesh" % (version,))
+                stored_params = json.loads(str(model['mesh_params']))
+                mesh_params = collections.OrderedDict()
+                for key, t in PROFILE_OPTIONS.items():
+                    mesh_params[key] = t(stored_params[key])
+                temps = model['temps']
+                mean = model['mean']
+                basis = model['basis']
+                weights = model['weights']
+        except (IOError, OSError, ValueError, KeyError) as e:
+            raise self.gcode.error(
+                "bed_mesh: Unable to load thermal model %s: %s"
+                % (self.thermal_model, str(e)))
+        thermal_mesh = LowRankThermalMesh(mesh_params)
+        if self.bedmesh.perf is not None:
+            self.bedmesh.perf.wrap(thermal_mesh, 'build_low_rank_mesh',
+                                   'build_mesh')
+        try:
+            thermal_mesh.build_low_rank_mesh(temps, mean, basis, weights)
+        except BedMeshError as e:
+            raise self.gcode.error(str(e))
+        logging.info("bed_mesh: Thermal mesh built from a rank %d model, "
+                     "%.1fC to %.1fC" % (len(basis), temps.min(),
+                                         temps.max()))
+        return thermal_mesh
+    def _build_thermal_mesh(self):
+        if self.thermal_model is not None:
+            return self._build_low_rank_mesh()
+        # Every profile named by a temperature (as generated for FDC)
+        # becomes a layer of the thermal mesh
+        temps = []
+        z_matrices = []
+        mesh_params = None
+        for prof_name in self.stored_profiles:
+            try:
+                temp = float(prof_name)
+            except ValueError:
+                continue
+            profile = self.get_profile(prof_name, cache=False)
+            if mesh_params is None:
+                mesh_params = profile['mesh_params']
+            elif profile['mesh_params'] != mesh_params:
+                logging.info(
+                    "bed_mesh: Profile [%s] mesh parameters differ from the "
+                    "other temperature profiles, skipped in thermal mesh"
+                    % (prof_name))
+                continue
+            temps.append(temp)
+            z_matrices.append(profile['points'])
+        if not temps:
+            raise self.gcode.error(
+                "bed_mesh: No temperature profiles found for thermal mesh")
+        thermal_mesh = ThermalMesh(mesh_params)
+        if self.bedmesh.perf is not None:
+            self.bedmesh.perf.wrap(thermal_mesh, 'build_thermal_mesh',
+                                   'build_mesh')
+        try:
+            thermal_mesh.build_thermal_mesh(temps, z_matrices)
+        except BedMeshError as e:
+            raise self.gcode.error(str(e))
+        logging.info("bed_mesh: Thermal mesh built from %d profiles, "
+                     "%.1fC to %.1fC" % (len(temps), min(temps), max(temps)))
+        return thermal_mesh
+    def load_thermal_mesh(self, temp):
+        if self.thermal_mesh is None:
+            self.thermal_mesh = self._build_thermal_mesh()
+        self.thermal_mesh.set_temperature(temp)
+        if self.bedmesh.get_mesh() is self.thermal_mesh:
+            # Temperature updated in place, no reload or position reset
+            self.bedmesh.update_mesh()
+            return
+        self.thermal_mesh.set_mesh_offsets([0., 0.])
+        self.current_profile = "thermal"
+        self.bedmesh.set_mesh(self.thermal_mesh)
     def remove_profile(self, prof_name):
-        if prof_name in self.profiles:
+        if self.stored_profiles.get(prof_name) is self.profile_store:
+            self._update_profile(prof_name, None)
+            self.bedmesh.update_status()
+            self.gcode.respond_info(
+                "Profile [%s] removed for this session, it is still in\n"
+                "the profile store and will be back after a restart"
+                % (prof_name))
+        elif prof_name in self.stored_profiles:
             configfile = self.printer.lookup_object('configfile')
             configfile.remove_section('bed_mesh ' + prof_name)
-            profiles = dict(self.profiles)
-            del profiles[prof_name]
-            self.profiles = profiles
+            self._update_profile(prof_name, None)
             self.bedmesh.update_status()
             self.gcode.respond_info(
                 "Profile [%s] removed from storage for this session.\n"
@@ -1224,6 +2309,16 @@ class ProfileManager:
         else:
             self.gcode.respond_info(
                 "No profile named [%s] to remove" % (prof_name))
+    def _get_profile_output(self, prof_name):
+        profile = self.get_profile(prof_name, cache=False)
+        return {'name': prof_name, 'points': profile['points'],
+                'mesh_params': profile['mesh_params']}
+    def output_profile(self, prof_name):
+        self.gcode.respond_raw(
+            "profile_output " + json.dumps(self._get_profile_output(prof_name)))
+    def _handle_profile_request(self, web_request):
+        web_request.send(
+            self._get_profile_output(web_request.get_str('name')))
     cmd_BED_MESH_PROFILE_help = "Bed Mesh Persistent Storage management"
     # added for tilt
     def get_middle_point_from_mesh(self, zpoints):
@@ -1252,69 +2347,90 @@ class ProfileManager:
         # first one is to middle zero and the second to apply the z offest
         return self.normal_mesh_to_point(zpoints, middle_z * 6)
 
-    def _tilt_mesh(self, zpoints, params, stepper_z, stepper_z1, stepper_z2):
+    def get_stepper_names(self):
+        # TILT_AND_LOAD parameter of each z_positions entry
+        return ['STEPPER_Z'] + ['STEPPER_Z%d' % (i,)
+                                for i in range(1, len(self.z_positions))]
+    def _calc_tilt_plane(self, zpoints, params, stepper_zs):
+        # The stepper tilt is applied as a plane on top of the mesh,
+        # the interpolated mesh itself is not changed (and stays cached)
         x_cnt, y_cnt = params["x_count"], params["y_count"]
         min_x, min_y = params["min_x"], params["min_y"]
         max_x, max_y = params["max_x"], params["max_y"]
 
-        p1 = np.array([self.z_positions[0][0], self.z_positions[0][1], stepper_z])
-        p2 = np.array([self.z_positions[1][0], self.z_positions[1][1], stepper_z1])
-        p3 = np.array([self.z_positions[2][0], self.z_positions[2][1], stepper_z2])
-
-        # These two vectors are in the plane
-        v1 = p3 - p1
-        v2 = p2 - p1
-
-        # the cross product is a vector normal to the plane
-        cp = np.cross(v1, v2)
-        a, b, c = cp
+        # Plane through the steppers (best fit for more than 3)
+        a, b, c = np.dot(self.tilt_projection, stepper_zs)
 
-        # This evaluates a * x3 + b * y3 + c * z3 which equals d
-        d = np.dot(cp, p3)
+        # Middle probe point, like G28 Z in the middle of the bed
+        middle_y = int(round(y_cnt / 2)) - 1
+        middle_x = int(round(x_cnt / 2)) - 1
+        middle_pos_x = np.linspace(min_x, max_x, num=x_cnt)[middle_x]
+        middle_pos_y = np.linspace(min_y, max_y, num=y_cnt)[middle_y]
+        middle_plane_z = a * middle_pos_x + b * middle_pos_y + c
+        middle_z_offset = zpoints[middle_y][middle_x] - middle_plane_z
 
-        X = np.linspace(min_x, max_x, num=x_cnt)
-        Y = np.linspace(min_y, max_y, num=y_cnt)
-        X, Y = np.meshgrid(X, Y)
-
-        # Clean plane with the tilt size of mesh_min, mesh_max with probe_count points
-        Z = (d - a * X - b * Y) / c
-        # Apply tilt to mesh
-        Z = np.array(zpoints) - Z
-
-        middle_z_offset = self.get_middle_point_from_mesh(Z)
-        # Like G28 Z in the middle of the bed
-        Z = self.normal_mesh_to_point(Z, middle_z_offset * -1)
-
-        return Z.tolist(), float(middle_z_offset)
-    def z_thermal_adjust(self, ref_temp, current_temp, z_offset):
+        # Un-tilt plane, zeroed at the middle point
+        tilt_plane = (float(-a), float(-b), float(-c - middle_z_offset))
+        return tilt_plane, float(middle_z_offset)
+    def _get_z_thermal(self, temp_coeff):
+        # z_thermal_adjust object a valid temp_coeff can be set on
+        z_thermal = self.printer.lookup_object('z_thermal_adjust', None)
+        if z_thermal is None:
+            raise self.gcode.error(
+                "bed_mesh: z_thermal_adjust is not configured")
+        if not -1. <= temp_coeff <= 1.:
+            raise self.gcode.error(
+                "bed_mesh: z_thermal_adjust temp_coeff %s out of range"
+                % (temp_coeff,))
+        return z_thermal
+    def set_z_thermal_coeff(self, temp_coeff):
+        # Same as SET_Z_THERMAL_ADJUST TEMP_COEFF=, without a gcode round
+        self._get_z_thermal(temp_coeff).temp_coeff = temp_coeff
+    def calc_z_thermal_coeff(self, ref_temp, current_temp, z_offset):
         # the temp_coeff should be low temp to high temp, it will handle the reverse (if we want z to go up, the coeff should be negative
         # we flip the z_offset because we applied the un-tilt to the mesh so it will go up
-        temp_coeff = (z_offset * -1) / abs(current_temp - ref_temp)
-        self.gcode.run_script_from_command("SET_Z_THERMAL_ADJUST TEMP_COEFF=%s" % temp_coeff)
+        return (z_offset * -1) / abs(current_temp - ref_temp)
     # added for tilt
-    def tilt_load_profile(self, prof_name, ref_temp, current_temp, stepper_z, stepper_z1, stepper_z2):
-        profile = self.profiles.get(prof_name, None)
-        if profile is None:
-            raise self.gcode.error(
-                "bed_mesh: Unknown profile [%s]" % prof_name)
-        probed_matrix = profile['points']
-        mesh_params = profile['mesh_params']
-        probed_matrix, z_offset = self._tilt_mesh(probed_matrix, mesh_params, stepper_z, stepper_z1, stepper_z2)
-        z_mesh = ZMesh(mesh_params)
-        try:
-            z_mesh.build_mesh(probed_matrix)
-        except BedMeshError as e:
-            raise self.gcode.error(str(e))
+    def tilt_load_profile(self, prof_name, ref_temp, current_temp, stepper_zs,
+                          deferred=False):
+        z_mesh = self._get_z_mesh(prof_name)
+        profile = self.get_profile(prof_name)
+        tilt_plane, z_offset = self._calc_tilt_plane(profile['points'], profile['mesh_params'], stepper_zs)
         # If we use the original name, when calling save_config the altered mesh will be saved
-        self.current_profile = "%s_Modified_base_%s" % (prof_name, ref_temp)
-        self.bedmesh.set_mesh(z_mesh)
-        self.z_thermal_adjust(ref_temp, current_temp, z_offset)
+        modified_name = "%s_Modified_base_%s" % (prof_name, ref_temp)
+        temp_coeff = self.calc_z_thermal_coeff(ref_temp, current_temp,
+                                               z_offset)
+        z_thermal = self._get_z_thermal(temp_coeff)
+        z_mesh.set_tilt_plane(tilt_plane)
+        active = self.bedmesh.get_mesh()
+        if (not deferred and active is not None
+                and active.probed_matrix is z_mesh.probed_matrix):
+            # Same mesh, only the tilt changed
+            active.set_mesh_offsets([0., 0.])
+            active.set_tilt_plane(tilt_plane)
+            self.current_profile = modified_name
+            self.bedmesh.update_mesh()
+        elif deferred:
+            # The coefficient is set with the mesh, on the next move
+            self.bedmesh.queue_mesh(
+                z_mesh, modified_name, self.printer.get_reactor().monotonic(),
+                self.bedmesh.request_mesh(),
+                functools.partial(setattr, z_thermal, 'temp_coeff',
+                                  temp_coeff))
+            return temp_coeff
+        else:
+            self.current_profile = modified_name
+            self.bedmesh.set_mesh(z_mesh)
+        z_thermal.temp_coeff = temp_coeff
+        return temp_coeff
     def cmd_BED_MESH_PROFILE(self, gcmd):
         options = collections.OrderedDict({
             'LOAD': self.load_profile,
             'SAVE': self.save_profile,
             'REMOVE': self.remove_profile,
-            'TILT_AND_LOAD': self.tilt_load_profile
+            'TILT_AND_LOAD': self.tilt_load_profile,
+            'THERMAL': self.load_thermal_mesh,
+            'OUTPUT': self.output_profile
         })
         for key in options:
             name = gcmd.get(key, None)
@@ -1325,10 +2441,9 @@ class ProfileManager:
                     )
                 # added for tilt
                 if key == 'TILT_AND_LOAD':
-                    stepper_z = gcmd.get_float('STEPPER_Z', None)
-                    stepper_z1 = gcmd.get_float('STEPPER_Z1', None)
-                    stepper_z2 = gcmd.get_float('STEPPER_Z2', None)
-                    if not (stepper_z and stepper_z1 and stepper_z2):
+                    stepper_zs = [gcmd.get_float(stepper, None)
+                                  for stepper in self.get_stepper_names()]
+                    if None in stepper_zs:
                         gcmd.respond_info("TILT_AND_LOAD Invalid syntax missing steppers or not float '%s'" % (gcmd.get_commandline(),))
                         return
                     ref_temp = gcmd.get_float('REF_TEMP', None)
@@ -1336,8 +2451,15 @@ class ProfileManager:
                     if not (ref_temp and current_temp):
                         gcmd.respond_info("TILT_AND_LOAD Invalid syntax missing ref or current temp or not float '%s'" % (gcmd.get_commandline(),))
                         return
-                    options[key](name, ref_temp, current_temp, stepper_z, stepper_z1, stepper_z2)
+                    options[key](name, ref_temp, current_temp, stepper_zs,
+                                 gcmd.get_int('DEFERRED', 0, minval=0,
+                                              maxval=1))
                     return
+                elif key == 'THERMAL':
+                    options[key](gcmd.get_float(key))
+                elif key == 'LOAD':
+                    options[key](name, gcmd.get_int('DEFERRED', 0, minval=0,
+                                                    maxval=1))
                 elif name == "default" and key == 'SAVE':
                     gcmd.respond_info(
                         "Profile 'default' is reserved, please choose"
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Throughput of BedMesh.move_batch against BedMesh.move
+
+Transforms a synthetic arc path (a spiral of short G2/G3 like segments)
+through both entry points, checks they send the same toolhead moves and
+reports segments/sec for each split mode.
+"""
+
+import argparse
+import math
+import sys
+import time
+
+from klippy_stubs import make_bed_mesh
+from bench_bed_mesh import BED_SIZE, PRINT_Z, make_sections
+
+
+class RecordingToolHead:
+    def __init__(self):
+        self.position = [0., 0., 0., 0.]
+        self.moves = []
+    def get_position(self):
+        return list(self.position)
+    def move(self, newpos, speed):
+        self.moves.append(list(newpos))
+        self.position[:] = newpos
+
+
+def make_arc_path(count, segment_length=.2):
+    # Concentric arcs around the bed center, like a slicer arc fitted
+    # perimeter cut into segments by Klipper's gcode_arcs
+    center = BED_SIZE / 2.
+    path = []
+    radius = 5.
+    angle = e = 0.
+    while len(path) < count:
+        angle += segment_length / radius
+        radius = min(5. + angle * .5, center - 10.)
+        e += segment_length * .05
+        path.append([center + radius * math.cos(angle),
+                     center + radius * math.sin(angle), PRINT_Z, e])
+    return path
+
+
+def run_path(bmesh, path, chunk):
+    toolhead = RecordingToolHead()
+    bmesh.toolhead = toolhead
+    bmesh.last_position[:] = path[0]
+    start = time.perf_counter()
+    if chunk:
+        for i in range(0, len(path), chunk):
+            bmesh.move_batch(path[i:i+chunk], 100.)
+    else:
+        for pos in path:
+            bmesh.move(pos, 100.)
+    return time.perf_counter() - start, toolhead.moves
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='bed_mesh batch move throughput')
+    parser.add_argument('--segments', default=100000, type=int,
+                        help='Segments of the arc path')
+    parser.add_argument('--chunk', default=[16, 128, 1024], type=int,
+                        nargs='+', help='Segments per move_batch call')
+    parser.add_argument('--probes', default=9, type=int,
+                        help='Probe count (NxN mesh)')
+    parser.add_argument('--pps', default=3, type=int,
+                        help='Mesh points per segment')
+    args = parser.parse_args()
+    algo = 'bicubic' if args.pps else 'direct'
+    path = make_arc_path(args.segments)
+
+    print("%-9s %-8s %-7s %12s %10s %9s %s" % (
+        "mode", "skip", "chunk", "segments/s", "toolhead", "speedup",
+        "same"))
+    for split_mode in ('distance', 'cell'):
+        for skip in ('True', 'False'):
+            options = {'split_mode': split_mode, 'flat_move_skip': skip}
+            sections = make_sections(args.probes, args.pps, algo, options)
+            name = [s.split(' ', 1)[1] for s in sections if s != 'bed_mesh'][0]
+            results = []
+            for chunk in [0] + args.chunk:
+                printer, bmesh = make_bed_mesh(sections)
+                bmesh.pmgr.load_profile(name)
+                results.append((chunk,) + run_path(bmesh, path, chunk))
+            base_time, base_moves = results[0][1:]
+            for chunk, elapsed, moves in results:
+                print("%-9s %-8s %-7s %12.0f %10d %8.2fx %s" % (
+                    split_mode, skip, chunk or "scalar",
+                    len(path) / elapsed, len(moves), base_time / elapsed,
+                    moves == base_moves))
+                if moves != base_moves:
+                    print("move_batch output differs from move()",
+                          file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of the bed_mesh transform hot path
+
+Runs ZMesh.calc_z, MoveSplitter.split, BedMesh.move,
+ProfileManager.load_profile and tilt_load_profile over synthetic meshes
+and a synthetic G-code move stream, and reports ops/sec and per call
+latency percentiles.  Use --json to save a run and --compare to compare
+it with a previous one.
+"""
+
+import argparse
+import json
+import math
+import platform
+import random
+import sys
+import time
+
+import numpy as np
+
+from klippy_stubs import make_bed_mesh
+
+MESH_MIN = (20., 20.)
+MESH_MAX = (280., 280.)
+BED_SIZE = 300.
+PRINT_Z = .2
+PROFILE_COUNT = 8
+Z_POSITIONS = "\n0,0\n150,300\n300,0"
+
+
+def get_algos(probe_count, pps):
+    # Same rules as BedMeshCalibrate._verify_algorithm
+    if pps == 0:
+        return ['direct']
+    algos = ['bicubic']
+    if probe_count <= 6:
+        algos.insert(0, 'lagrange')
+    return algos
+
+
+def make_sections(probe_count, pps, algo, options):
+    rnd = random.Random(probe_count * 1000 + pps)
+    sections = {'bed_mesh': {
+        'mesh_min': "%s,%s" % MESH_MIN, 'mesh_max': "%s,%s" % MESH_MAX,
+        'probe_count': "%d,%d" % (probe_count, probe_count),
+        'mesh_pps': "%d,%d" % (pps, pps),
+        'algorithm': 'bicubic' if algo == 'direct' else algo,
+        'fade_end': '0', 'z_positions': Z_POSITIONS}}
+    sections['bed_mesh'].update(options)
+    for i in range(PROFILE_COUNT):
+        # A slowly deforming bed, like the FDC temperature profiles
+        bow = .05 + .01 * i
+        rows = []
+        for yi in range(probe_count):
+            y = yi / (probe_count - 1.) - .5
+            row = []
+            for xi in range(probe_count):
+                x = xi / (probe_count - 1.) - .5
+                row.append(bow * (x * x + y * y) + rnd.uniform(-.01, .01))
+            rows.append(", ".join(["%.6f" % z for z in row]))
+        sections['bed_mesh %.1f' % (30. + .1 * i,)] = {
+            'version': '1', 'points': "\n" + "\n".join(rows),
+            'min_x': str(MESH_MIN[0]), 'max_x': str(MESH_MAX[0]),
+            'min_y': str(MESH_MIN[1]), 'max_y': str(MESH_MAX[1]),
+            'x_count': str(probe_count), 'y_count': str(probe_count),
+            'mesh_x_pps': str(pps), 'mesh_y_pps': str(pps),
+            'algo': algo, 'tension': '0.2'}
+    return sections
+
+
+def make_move_stream(count, seed=0):
+    # Synthetic G-code moves: short curve segments, perimeter/infill
+    # lines and travel moves in random directions over the bed
+    rnd = random.Random(seed)
+    x = y = BED_SIZE / 2.
+    e = 0.
+    moves = []
+    while len(moves) < count:
+        kind = rnd.random()
+        if kind < .6:
+            # curve, split in many short segments by the slicer
+            segments = rnd.randint(5, 40)
+            length = rnd.uniform(.1, 2.)
+            angle = rnd.uniform(0., 2. * math.pi)
+            turn = rnd.uniform(-.3, .3)
+        elif kind < .9:
+            segments, length = 1, rnd.uniform(2., 40.)
+            angle, turn = rnd.uniform(0., 2. * math.pi), 0.
+        else:
+            segments, length = 1, rnd.uniform(20., 250.)
+            angle, turn = rnd.uniform(0., 2. * math.pi), 0.
+        for _ in range(segments):
+            x = min(max(x + length * math.cos(angle), 0.), BED_SIZE)
+            y = min(max(y + length * math.sin(angle), 0.), BED_SIZE)
+            if kind < .9:
+                e += length * .05
+            moves.append([x, y, PRINT_Z, e])
+            angle += turn
+    return moves[:count]
+
+
+def summarize(latencies):
+    latencies = np.asarray(latencies)
+    total = latencies.sum()
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+    return {
+        'calls': len(latencies),
+        'ops_per_sec': len(latencies) / total if total else 0.,
+        'p50_us': p50 * 1e6, 'p90_us': p90 * 1e6, 'p99_us': p99 * 1e6,
+        'max_us': latencies.max() * 1e6}
+
+
+def bench_calc_z(bmesh, points):
+    calc_z = bmesh.get_mesh().calc_z
+    timer = time.perf_counter
+    latencies = []
+    for x, y in points:
+        start = timer()
+        calc_z(x, y)
+        latencies.append(timer() - start)
+    return latencies, {}
+
+
+def bench_split(bmesh, moves):
+    splitter = bmesh.splitter
+    timer = time.perf_counter
+    latencies = []
+    splits = 0
+    prev_pos = list(moves[0])
+    for pos in moves[1:]:
+        start = timer()
+        splitter.build_move(prev_pos, pos, 1.)
+        while not splitter.traverse_complete:
+            splitter.split()
+            splits += 1
+        latencies.append(timer() - start)
+        prev_pos = pos
+    return latencies, {'splits_per_move': splits / float(len(latencies))}
+
+
+def bench_move(printer, bmesh, moves):
+    toolhead = printer.lookup_object('toolhead')
+    toolhead.move_count = 0
+    timer = time.perf_counter
+    latencies = []
+    for pos in moves:
+        start = timer()
+        bmesh.move(pos, 100.)
+        latencies.append(timer() - start)
+    return latencies, {
+        'toolhead_moves_per_move': toolhead.move_count / float(len(moves))}
+
+
+def bench_load_profile(bmesh, names, count):
+    pmgr = bmesh.pmgr
+    timer = time.perf_counter
+    latencies = []
+    for i in range(count):
+        start = timer()
+        pmgr.load_profile(names[i % len(names)])
+        latencies.append(timer() - start)
+    return latencies, {}
+
+
+def bench_tilt_load_profile(bmesh, names, count):
+    pmgr = bmesh.pmgr
+    rnd = random.Random(1)
+    steppers = len(pmgr.get_stepper_names())
+    timer = time.perf_counter
+    latencies = []
+    for i in range(count):
+        stepper_zs = [rnd.uniform(-.05, .05) for _ in range(steppers)]
+        start = timer()
+        pmgr.tilt_load_profile(names[i % len(names)], 30., 31., stepper_zs)
+        latencies.append(timer() - start)
+    return latencies, {}
+
+
+def run_case(probe_count, pps, algo, args, options, points, moves):
+    results = []
+    def add(bench, latencies, extra):
+        result = {'bench': bench, 'probes': probe_count, 'pps': pps,
+                  'algo': algo}
+        result.update(summarize(latencies))
+        result.update(extra)
+        results.append(result)
+    sections = make_sections(probe_count, pps, algo, options)
+    names = [s.split(' ', 1)[1] for s in sections if s != 'bed_mesh']
+    # Profile loads without the mesh cache
+    cold_options = dict(options, mesh_cache_size='0')
+    printer, bmesh = make_bed_mesh(
+        make_sections(probe_count, pps, algo, cold_options))
+    add('load_profile_cold', *bench_load_profile(bmesh, names, args.loads))
+    printer, bmesh = make_bed_mesh(sections)
+    bench_load_profile(bmesh, names, len(names))
+    add('load_profile', *bench_load_profile(bmesh, names, args.loads))
+    add('tilt_load_profile',
+        *bench_tilt_load_profile(bmesh, names, args.loads))
+    bmesh.pmgr.load_profile(names[0])
+    add('calc_z', *bench_calc_z(bmesh, points))
+    add('split', *bench_split(bmesh, moves))
+    add('move', *bench_move(printer, bmesh, moves))
+    return results
+
+
+def result_key(result):
+    return (result['bench'], result['probes'], result['pps'],
+            result['algo'])
+
+
+def print_results(results, baseline=None):
+    header = "%-18s %-6s %-4s %-9s %8s %12s %9s %9s %9s %9s" % (
+        "bench", "probes", "pps", "algo", "calls", "ops/s", "p50 us",
+        "p90 us", "p99 us", "max us")
+    if baseline is not None:
+        header += " %8s" % ("vs base",)
+    print(header)
+    for r in results:
+        line = "%-18s %-6s %-4d %-9s %8d %12.0f %9.1f %9.1f %9.1f %9.1f" % (
+            r['bench'], "%dx%d" % (r['probes'], r['probes']), r['pps'],
+            r['algo'], r['calls'], r['ops_per_sec'], r['p50_us'],
+            r['p90_us'], r['p99_us'], r['max_us'])
+        if baseline is not None:
+            base = baseline.get(result_key(r))
+            if base is not None and base['ops_per_sec']:
+                line += " %7.2fx" % (r['ops_per_sec'] / base['ops_per_sec'],)
+            else:
+                line += " %8s" % ("-",)
+        print(line)
+
+
+def parse_options(option_list):
+    options = {}
+    for option in option_list:
+        key, sep, value = option.partition('=')
+        if not sep:
+            raise SystemExit("Invalid --set '%s', use option=value"
+                             % (option,))
+        options[key.strip()] = value.strip()
+    return options
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='bed_mesh hot path benchmarks')
+    parser.add_argument('--probes', default=[5, 9, 13, 17, 21], type=int,
+                        nargs='+', help='Probe counts (NxN meshes)')
+    parser.add_argument('--pps', default=[0, 2, 4, 6, 8], type=int,
+                        nargs='+', help='Mesh points per segment')
+    parser.add_argument('--algos', default=['direct', 'lagrange', 'bicubic'],
+                        nargs='+', help='Interpolation algorithms')
+    parser.add_argument('--points', default=20000, type=int,
+                        help='calc_z calls per case')
+    parser.add_argument('--moves', default=2000, type=int,
+                        help='Moves of the synthetic G-code stream')
+    parser.add_argument('--loads', default=40, type=int,
+                        help='Profile loads per case')
+    parser.add_argument('--set', default=[], action='append',
+                        metavar='OPTION=VALUE',
+                        help='Extra [bed_mesh] option, e.g. split_mode=cell')
+    parser.add_argument('--json', default=None, metavar='FILE',
+                        help='Write the results to a JSON file')
+    parser.add_argument('--compare', default=None, metavar='FILE',
+                        help='JSON file of a previous run to compare with')
+    args = parser.parse_args()
+    options = parse_options(args.set)
+
+    rnd = random.Random(0)
+    points = [(rnd.uniform(0., BED_SIZE), rnd.uniform(0., BED_SIZE))
+              for _ in range(args.points)]
+    moves = make_move_stream(args.moves)
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            baseline = dict([(result_key(r), r)
+                             for r in json.load(f)['results']])
+
+    results = []
+    for probe_count in args.probes:
+        for pps in args.pps:
+            for algo in get_algos(probe_count, pps):
+                if algo not in args.algos:
+                    continue
+                print("Running %dx%d pps %d %s..." % (
+                    probe_count, probe_count, pps, algo), file=sys.stderr)
+                results.extend(run_case(probe_count, pps, algo, args,
+                                        options, points, moves))
+    print_results(results, baseline)
+
+    if args.json is not None:
+        output = {
+            'environment': {
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'machine': platform.machine(),
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+            'options': {
+                'points': args.points, 'moves': args.moves,
+                'loads': args.loads, 'bed_mesh': options},
+            'results': results}
+        with open(args.json, 'w') as f:
+            json.dump(output, f, indent=2)
+        print("Results written to %s" % (args.json,))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark of ZMesh.calc_z
+
+Compares the per cell coefficient table lookup against the previous
+implementation (index search and three lerps on the nested mesh lists)
+"""
+
+import argparse
+import functools
+import math
+import random
+import time
+
+from klippy_stubs import load_bed_mesh
+
+bed_mesh = load_bed_mesh()
+
+
+def legacy_calc_z(z_mesh, x, y):
+    # calc_z as it was before the coefficient table
+    def get_linear_index(coord, axis):
+        if axis == 0:
+            mesh_min = z_mesh.mesh_x_min
+            mesh_cnt = z_mesh.mesh_x_count
+            mesh_dist = z_mesh.mesh_x_dist
+            cfunc = z_mesh.get_x_coordinate
+        else:
+            mesh_min = z_mesh.mesh_y_min
+            mesh_cnt = z_mesh.mesh_y_count
+            mesh_dist = z_mesh.mesh_y_dist
+            cfunc = z_mesh.get_y_coordinate
+        idx = int(math.floor((coord - mesh_min) / mesh_dist))
+        idx = bed_mesh.constrain(idx, 0, mesh_cnt - 2)
+        t = (coord - cfunc(idx)) / mesh_dist
+        return bed_mesh.constrain(t, 0., 1.), idx
+    tbl = z_mesh.mesh_matrix
+    tx, xidx = get_linear_index(x + z_mesh.mesh_offsets[0], 0)
+    ty, yidx = get_linear_index(y + z_mesh.mesh_offsets[1], 1)
+    z0 = bed_mesh.lerp(tx, tbl[yidx][xidx], tbl[yidx][xidx+1])
+    z1 = bed_mesh.lerp(tx, tbl[yidx+1][xidx], tbl[yidx+1][xidx+1])
+    return bed_mesh.lerp(ty, z0, z1)
+
+
+def make_mesh(probe_count, pps):
+    params = {
+        'min_x': 20., 'max_x': 280., 'min_y': 20., 'max_y': 280.,
+        'x_count': probe_count, 'y_count': probe_count,
+        'mesh_x_pps': pps, 'mesh_y_pps': pps,
+        'algo': 'bicubic', 'tension': .2}
+    rnd = random.Random(probe_count * 100 + pps)
+    points = [[rnd.uniform(-.2, .2) for _ in range(probe_count)]
+              for _ in range(probe_count)]
+    z_mesh = bed_mesh.ZMesh(params)
+    z_mesh.build_mesh(points)
+    return z_mesh
+
+
+def calls_per_second(func, points, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for x, y in points:
+            func(x, y)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return len(points) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ZMesh.calc_z benchmark')
+    parser.add_argument('--points', default=100000, type=int,
+                        help='Number of calc_z calls per run')
+    parser.add_argument('--repeat', default=3, type=int,
+                        help='Runs per case, the best one is reported')
+    args = parser.parse_args()
+
+    rnd = random.Random(0)
+    points = [(rnd.uniform(0., 300.), rnd.uniform(0., 300.))
+              for _ in range(args.points)]
+    print("%-8s %-4s %14s %14s %8s" % (
+        "probes", "pps", "before [1/s]", "after [1/s]", "speedup"))
+    for probe_count in (7, 15):
+        for pps in range(2, 7):
+            z_mesh = make_mesh(probe_count, pps)
+            max_diff = max(abs(legacy_calc_z(z_mesh, x, y)
+                               - z_mesh.calc_z(x, y)) for x, y in points)
+            if max_diff > 1e-9:
+                raise Exception("calc_z mismatch %s" % max_diff)
+            before = calls_per_second(
+                functools.partial(legacy_calc_z, z_mesh), points, args.repeat)
+            after = calls_per_second(z_mesh.calc_z, points, args.repeat)
+            print("%-8s %-4d %14.0f %14.0f %7.2fx" % (
+                "%dx%d" % (probe_count, probe_count), pps, before, after,
+                after / before))
+
+
+if __name__ == "__main__":
+    main()
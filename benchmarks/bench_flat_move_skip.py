@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Check and throughput of the bed_mesh flat_move_skip option
+
+Sends the same random move stream through BedMesh.move with
+flat_move_skip enabled and disabled, with a tilted mesh and moves that
+run off the mesh, checks that both send the same toolhead moves and
+reports moves/sec for each split mode.
+"""
+
+import argparse
+import random
+import sys
+import time
+
+from klippy_stubs import make_bed_mesh
+from bench_bed_mesh import (MESH_MIN, MESH_MAX, get_algos, make_sections,
+                            make_move_stream)
+from bench_batch_moves import RecordingToolHead
+
+
+def is_off_mesh(pos):
+    return not (MESH_MIN[0] <= pos[0] <= MESH_MAX[0]
+                and MESH_MIN[1] <= pos[1] <= MESH_MAX[1])
+
+
+def run_moves(bmesh, moves):
+    toolhead = RecordingToolHead()
+    bmesh.toolhead = toolhead
+    bmesh.last_position[:] = moves[0]
+    ends = []
+    start = time.perf_counter()
+    for pos in moves[1:]:
+        bmesh.move(pos, 100.)
+        ends.append(len(toolhead.moves))
+    elapsed = time.perf_counter() - start
+    # Toolhead moves of each gcode move
+    starts = [0] + ends[:-1]
+    return elapsed, [toolhead.moves[a:b] for a, b in zip(starts, ends)]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='bed_mesh flat_move_skip check')
+    parser.add_argument('--moves', default=20000, type=int,
+                        help='Moves of the random move stream')
+    parser.add_argument('--probes', default=[5, 9], type=int, nargs='+',
+                        help='Probe counts (NxN meshes)')
+    parser.add_argument('--pps', default=[0, 3], type=int, nargs='+',
+                        help='Mesh points per segment')
+    parser.add_argument('--tilt', default=1., type=float,
+                        help='Largest z offset of a z stepper (mm)')
+    parser.add_argument('--seed', default=0, type=int,
+                        help='Seed of the move stream and the tilt')
+    args = parser.parse_args()
+    moves = make_move_stream(args.moves, args.seed)
+    off_mesh = [is_off_mesh(a) or is_off_mesh(b)
+                for a, b in zip(moves[:-1], moves[1:])]
+    print("%d moves, %d partly off the mesh" % (len(moves) - 1,
+                                                sum(off_mesh)))
+    print("%-9s %-7s %-9s %10s %10s %8s %6s %6s" % (
+        "mode", "probes", "algo", "skip/s", "split/s", "speedup",
+        "diff", "off"))
+    failed = False
+    for split_mode in ('distance', 'cell'):
+        for probe_count in args.probes:
+            for pps in args.pps:
+                for algo in get_algos(probe_count, pps):
+                    results = []
+                    for skip in ('True', 'False'):
+                        options = {'split_mode': split_mode,
+                                   'flat_move_skip': skip}
+                        sections = make_sections(probe_count, pps, algo,
+                                                 options)
+                        name = [s.split(' ', 1)[1] for s in sections
+                                if s != 'bed_mesh'][0]
+                        printer, bmesh = make_bed_mesh(sections)
+                        pmgr = bmesh.pmgr
+                        rnd = random.Random(args.seed)
+                        stepper_zs = [rnd.uniform(-args.tilt, args.tilt)
+                                      for _ in pmgr.get_stepper_names()]
+                        pmgr.tilt_load_profile(name, 30., 31., stepper_zs)
+                        results.append(run_moves(bmesh, moves))
+                    (skip_time, skip_moves), (split_time, split_moves) = \
+                        results
+                    diffs = [a != b for a, b in zip(skip_moves,
+                                                    split_moves)]
+                    diff = sum(diffs)
+                    off = sum([d and o for d, o in zip(diffs, off_mesh)])
+                    failed |= diff > 0
+                    print("%-9s %-7d %-9s %10.0f %10.0f %7.2fx %6d %6d" % (
+                        split_mode, probe_count, algo,
+                        len(moves) / skip_time, len(moves) / split_time,
+                        split_time / skip_time, diff, off))
+    if failed:
+        print("flat_move_skip output differs from the splitter",
+              file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
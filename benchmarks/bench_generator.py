@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the generator's spline fitting
+
+Fits a large synthetic soak (many temperatures, dense meshes) along the
+temperature axis with interpolate_list, once per mesh point / stepper
+(the old loop) and once for the whole stack, and reports the time of
+each and the largest difference between them.  Then writes the meshes
+with configparser (add_bed_meshes + write_config) and with the streaming
+write_bed_meshes and checks the files are identical.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+import generate_FDC_meshes_z_heights as generator
+
+
+def make_soak(probe_count, measurements, steppers, step, seed=0):
+    # Frame temperatures of a soak, a bowing mesh and z stepper drift
+    # that grow with temperature, plus probe noise
+    rnd = np.random.default_rng(seed)
+    temps = 25. + np.cumsum(rnd.uniform(.05, .15, measurements))
+    temps = np.unique(np.round(temps / step) * step)
+    rise = (temps - temps[0]) / (temps[-1] - temps[0])
+    yy, xx = np.mgrid[-1:1:probe_count * 1j, -1:1:probe_count * 1j]
+    meshes = (.05 * rise[:, None, None] * (xx * xx + yy * yy)
+              + .02 * rise[:, None, None] ** 2 * xx * yy
+              + rnd.normal(0., .003, (len(temps), probe_count, probe_count)))
+    drift = (.1 * rise[None, :] * rnd.uniform(.5, 1.5, (steppers, 1))
+             + rnd.normal(0., .002, (steppers, len(temps))))
+    steps_length = int(round((temps[-1] - temps[0]) / step))
+    new_temps = np.linspace(temps[0], temps[-1], steps_length + 1)
+    return temps, new_temps, meshes, drift
+
+
+def fit_loop(temps, new_temps, meshes, drift, filter_noise):
+    points = np.moveaxis(meshes, 0, -1).reshape(-1, len(meshes))
+    new_points = np.array([generator.interpolate_list(
+        temps, new_temps, p, filter_noise=filter_noise) for p in points])
+    new_meshes = np.moveaxis(new_points.reshape(
+        meshes.shape[1], meshes.shape[2], len(new_temps)), -1, 0)
+    new_drift = np.array([generator.interpolate_list(
+        temps, new_temps, d, filter_noise=filter_noise) for d in drift])
+    return new_meshes, new_drift
+
+
+def fit_batch(temps, new_temps, meshes, drift, filter_noise):
+    return (generator.interpolate_list(temps, new_temps, meshes,
+                                       filter_noise=filter_noise),
+            generator.interpolate_list(temps, new_temps, drift, axis=1,
+                                       filter_noise=filter_noise))
+
+
+MESH_PARAMS = {'min_x': 20., 'max_x': 280., 'min_y': 20., 'max_y': 280.,
+               'x_count': 0, 'y_count': 0, 'mesh_x_pps': 2, 'mesh_y_pps': 2,
+               'algo': 'bicubic', 'tension': .2}
+
+
+def bench_writers(new_temps, new_meshes, step):
+    mesh_params = dict(MESH_PARAMS, x_count=new_meshes.shape[2],
+                       y_count=new_meshes.shape[1])
+    outputs = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name in ('configparser', 'streaming'):
+            dest = os.path.join(tmpdir, name + '.cfg')
+            start = time.perf_counter()
+            if name == 'configparser':
+                generator.write_config(generator.add_bed_meshes(
+                    new_temps, new_meshes, mesh_params, step), dest)
+            else:
+                generator.write_bed_meshes(
+                    new_temps, new_meshes, mesh_params, step, dest)
+            elapsed = time.perf_counter() - start
+            if name == 'configparser':
+                base_time = elapsed
+            with open(dest, 'rb') as f:
+                outputs.append(f.read())
+            print("%-12s %9.3f s %8.2fx" % (name, elapsed,
+                                            base_time / elapsed))
+    print("%d bytes, identical: %s" % (len(outputs[0]),
+                                       outputs[0] == outputs[1]))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='generate_FDC_meshes_z_heights spline fitting benchmark')
+    parser.add_argument('--probes', default=15, type=int,
+                        help='Probe count (NxN meshes)')
+    parser.add_argument('--measurements', default=1500, type=int,
+                        help='Measurements of the soak')
+    parser.add_argument('--steppers', default=4, type=int,
+                        help='Z steppers (tram curves)')
+    parser.add_argument('--step', default=.1, type=float,
+                        help='Temperature step of the generated data')
+    parser.add_argument('--no-filter', dest='filter_noise',
+                        action='store_false', help='Skip savgol_filter')
+    args = parser.parse_args()
+
+    temps, new_temps, meshes, drift = make_soak(
+        args.probes, args.measurements, args.steppers, args.step)
+    print("%d temperatures -> %d steps, %dx%d meshes, %d steppers" % (
+        len(temps), len(new_temps), args.probes, args.probes, args.steppers))
+    results = []
+    for name, fit in (('loop', fit_loop), ('batch', fit_batch)):
+        start = time.perf_counter()
+        results.append(fit(temps, new_temps, meshes, drift,
+                           args.filter_noise))
+        elapsed = time.perf_counter() - start
+        if name == 'loop':
+            loop_time = elapsed
+        print("%-6s %9.3f s %8.2fx" % (name, elapsed, loop_time / elapsed))
+    print("max difference: meshes %.3g mm, tram curves %.3g mm" % (
+        np.abs(results[0][0] - results[1][0]).max(),
+        np.abs(results[0][1] - results[1][1]).max()))
+    bench_writers(new_temps, results[1][0], args.step)
+
+
+if __name__ == "__main__":
+    main()
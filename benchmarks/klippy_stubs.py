@@ -0,0 +1,209 @@
+# Minimal stand-ins for the Klipper objects bed_mesh.py depends on, so the
+# module can be imported and benchmarked outside of Klipper.
+import os, sys, time, types, importlib.util
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE = 'klippy_extras_stub'
+
+def load_extra(name):
+    # Load a Klipper extra from the repo as part of a stub package, the
+    # extras use relative imports (from . import probe)
+    if PACKAGE not in sys.modules:
+        pkg = types.ModuleType(PACKAGE)
+        pkg.__path__ = []
+        sys.modules[PACKAGE] = pkg
+        probe = types.ModuleType(PACKAGE + '.probe')
+        probe.ProbePointsHelper = ProbePointsHelper
+        sys.modules[PACKAGE + '.probe'] = probe
+        pkg.probe = probe
+    full_name = '%s.%s' % (PACKAGE, name)
+    if full_name in sys.modules:
+        return sys.modules[full_name]
+    spec = importlib.util.spec_from_file_location(
+        full_name, os.path.join(REPO_DIR, name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[full_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+def load_bed_mesh():
+    return load_extra('bed_mesh')
+
+class ProbePointsHelper:
+    def __init__(self, config, finalize_callback, default_points=None):
+        pass
+    def minimum_points(self, n):
+        pass
+    def use_xy_offsets(self, use_offsets):
+        pass
+    def update_probe_points(self, points, min_points):
+        pass
+
+
+######################################################################
+# Config, printer and toolhead
+######################################################################
+
+class ConfigError(Exception):
+    pass
+
+class GCodeError(Exception):
+    pass
+
+_SENTINEL = object()
+
+class Config:
+    # ConfigWrapper subset used by bed_mesh, sections is a dict of
+    # section name -> dict of option -> string value
+    error = ConfigError
+    def __init__(self, printer, sections, section):
+        self.printer = printer
+        self.sections = sections
+        self.section = section
+    def get_printer(self):
+        return self.printer
+    def get_name(self):
+        return self.section
+    def _get(self, option, default, parser):
+        options = self.sections[self.section]
+        if option not in options:
+            if default is _SENTINEL:
+                raise self.error("Option '%s' in section '%s' must be "
+                                 "specified" % (option, self.section))
+            return default
+        try:
+            return parser(options[option])
+        except ValueError as e:
+            raise self.error("Unable to parse option '%s' in section '%s': "
+                             "%s" % (option, self.section, e))
+    def get(self, option, default=_SENTINEL, **kw):
+        return self._get(option, default, str)
+    def getint(self, option, default=_SENTINEL, **kw):
+        return self._get(option, default, int)
+    def getfloat(self, option, default=_SENTINEL, **kw):
+        return self._get(option, default, float)
+    def getboolean(self, option, default=_SENTINEL, **kw):
+        return self._get(option, default,
+                         lambda v: v.strip().lower() in ('1', 'true', 'yes'))
+    def getchoice(self, option, choices, default=_SENTINEL, **kw):
+        value = self._get(option, default, str)
+        if value not in choices:
+            raise self.error("Choice '%s' for option '%s' is not valid"
+                             % (value, option))
+        return choices[value] if isinstance(choices, dict) else value
+    def getlists(self, option, default=_SENTINEL, seps=(',',), count=None,
+                 parser=str, **kw):
+        def parse(value):
+            lines = [l.strip() for l in value.split('\n') if l.strip()]
+            return tuple(tuple(parser(p.strip()) for p in l.split(',')
+                               if p.strip()) for l in lines)
+        return self._get(option, default, parse)
+    def getfloatlist(self, option, default=_SENTINEL, count=None, **kw):
+        return self._get(option, default, lambda v: tuple(
+            float(p) for p in v.split(',') if p.strip()))
+    def getintlist(self, option, default=_SENTINEL, count=None, **kw):
+        return self._get(option, default, lambda v: tuple(
+            int(p) for p in v.split(',') if p.strip()))
+    def get_prefix_sections(self, prefix):
+        return [Config(self.printer, self.sections, s)
+                for s in self.sections if s.startswith(prefix)]
+
+class GCode:
+    error = GCodeError
+    def __init__(self):
+        self.commands = {}
+    def register_command(self, cmd, func, when_not_ready=False, desc=None):
+        self.commands[cmd] = func
+    def respond_info(self, msg, log=True):
+        pass
+    def respond_raw(self, msg):
+        pass
+    def run_script_from_command(self, script):
+        pass
+    run_script = run_script_from_command
+
+class GCodeMove:
+    def __init__(self):
+        self.move_transform = None
+    def set_move_transform(self, transform, force=False):
+        self.move_transform = transform
+    def reset_last_position(self):
+        if self.move_transform is not None:
+            self.move_transform.get_position()
+
+class ToolHead:
+    # Only keeps the position, moves are counted
+    def __init__(self):
+        self.position = [0., 0., 0., 0.]
+        self.move_count = 0
+    def get_position(self):
+        return list(self.position)
+    def move(self, newpos, speed):
+        self.position[:] = newpos
+        self.move_count += 1
+
+class ConfigFile:
+    def set(self, section, option, value):
+        pass
+    def remove_section(self, section):
+        pass
+
+class Webhooks:
+    def __init__(self):
+        self.endpoints = {}
+    def register_endpoint(self, path, callback):
+        self.endpoints[path] = callback
+
+class ZThermalAdjust:
+    def __init__(self):
+        self.temp_coeff = 0.
+
+class Reactor:
+    NOW = 0.
+    NEVER = 9999999999999999.
+    def __init__(self):
+        self.callbacks = []
+    def monotonic(self):
+        return time.perf_counter()
+    def register_callback(self, callback, waketime=NOW):
+        self.callbacks.append(callback)
+    register_async_callback = register_callback
+    def run_callbacks(self):
+        while self.callbacks:
+            self.callbacks.pop(0)(self.monotonic())
+
+class Printer:
+    def __init__(self):
+        self.reactor = Reactor()
+        self.objects = {
+            'gcode': GCode(), 'gcode_move': GCodeMove(),
+            'toolhead': ToolHead(), 'configfile': ConfigFile(),
+            'webhooks': Webhooks(),
+            'z_thermal_adjust': ZThermalAdjust()}
+        self.event_handlers = {}
+    def get_reactor(self):
+        return self.reactor
+    def get_start_args(self):
+        return {'config_file': os.path.join(os.getcwd(), 'printer.cfg')}
+    def lookup_object(self, name, default=_SENTINEL):
+        if name in self.objects:
+            return self.objects[name]
+        if default is _SENTINEL:
+            raise ConfigError("Unknown config object '%s'" % (name,))
+        return default
+    def load_object(self, config, section):
+        return self.objects[section]
+    def register_event_handler(self, event, callback):
+        self.event_handlers.setdefault(event, []).append(callback)
+    def send_event(self, event, *params):
+        return [cb(*params) for cb in self.event_handlers.get(event, [])]
+
+def make_bed_mesh(sections):
+    # Load [bed_mesh] from a sections dict and connect it to the stub
+    # printer, returns (printer, bed_mesh object)
+    bed_mesh = load_bed_mesh()
+    printer = Printer()
+    bmesh = bed_mesh.load_config(Config(printer, sections, 'bed_mesh'))
+    printer.objects['bed_mesh'] = bmesh
+    printer.send_event("klippy:connect")
+    return printer, bmesh
@@ -0,0 +1,374 @@
+# Frame deformation compensation
+#
+# Native replacement of the _FDC, _Z_HEIGHT_ADJUST, _TILT_AND_LOAD_MESH
+# and RUN_FDC macros of FDC.cfg, the mesh and the z_thermal_adjust
+# coefficient are set directly without gcode commands
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import logging, ast
+import numpy as np
+
+def parse_table(config, option, default=None):
+    # Tables use the same python dict format as the FDC.cfg variables
+    value = config.get(option, None)
+    if value is None:
+        if default is not None:
+            return default
+        raise config.error("fdc: option '%s' must be specified" % (option,))
+    try:
+        table = ast.literal_eval(value.strip())
+    except (ValueError, SyntaxError) as e:
+        raise config.error("fdc: unable to parse '%s': %s" % (option, e))
+    if not isinstance(table, dict):
+        raise config.error("fdc: '%s' must be a dict" % (option,))
+    return table
+
+def round_by_step(temp, step, precision):
+    return round(round(temp / step) * step, precision)
+
+
+class TempTable:
+    # Per temperature step z deltas held in an array indexed by step
+    def __init__(self, config, name, table, temp_min, step, precision):
+        self.gcode = config.get_printer().lookup_object('gcode')
+        self.name = name
+        self.temp_min = temp_min
+        self.step = step
+        self.deltas = np.zeros(len(table))
+        for temp, delta in table.items():
+            idx = self.get_index(float(temp))
+            if idx < 0 or idx >= len(table):
+                raise config.error(
+                    "fdc: %s temperature %s is not on the %s step grid "
+                    "starting at %s" % (name, temp, step, temp_min))
+            self.deltas[idx] = delta
+        self.precision = precision
+        self.temp_max = round_by_step(
+            temp_min + (len(table) - 1) * step, step, precision)
+        # Prefix sums with a leading zero, cumulative[i] is the sum of
+        # the deltas of the first i steps
+        self.cumulative = np.concatenate(([0.], np.cumsum(self.deltas)))
+    def get_index(self, temp):
+        return int(round((temp - self.temp_min) / self.step))
+    def range_sum(self, temp_from, temp_to):
+        # Sum of the deltas of every step from temp_from to temp_to,
+        # both included, the same as the macros summing last_temp_range
+        lo = self.get_index(min(temp_from, temp_to))
+        hi = self.get_index(max(temp_from, temp_to))
+        if lo < 0 or hi >= len(self.deltas):
+            raise self.gcode.error(
+                "fdc: %s has no values from %s to %s, the table covers "
+                "%s to %s" % (self.name, temp_from, temp_to, self.temp_min,
+                              self.temp_max))
+        return float(self.cumulative[hi + 1] - self.cumulative[lo])
+
+
+class FDC:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.reactor = self.printer.get_reactor()
+        self.gcode = self.printer.lookup_object('gcode')
+        self.enable = config.getboolean('enable', True)
+        self.thermistor_name = config.get('thermistor_name',
+                                          'z_thermal_adjust')
+        self.update_interval = config.getfloat('update_interval', 10.,
+                                               above=0.)
+        self.hysteresis = config.getfloat('hysteresis', .025, minval=0.)
+        self.step = config.getfloat('step', .1, above=0.)
+        self.precision = config.getint('precision', 1, minval=0)
+        self.enable_tram = config.getboolean('enable_tram', False)
+        self.thermal_mesh = config.getboolean('thermal_mesh', False)
+        # Swap the mesh on the next move instead of immediately, needs
+        # the FDC bed_mesh.py
+        self.deferred_swap = config.getboolean('deferred_swap', False)
+        z_height_temps = parse_table(config, 'z_height_temps')
+        z_trams_temps = parse_table(config, 'z_trams_temps', {})
+        if not z_height_temps:
+            raise config.error("fdc: z_height_temps is empty")
+        temps = sorted([float(t) for t in z_height_temps])
+        self.z_heights = TempTable(
+            config, 'z_height_temps', z_height_temps, temps[0],
+            self.step, self.precision)
+        self.z_trams = {}
+        for stepper, table in z_trams_temps.items():
+            if not table:
+                continue
+            stepper_temps = sorted([float(t) for t in table])
+            self.z_trams[stepper] = TempTable(
+                config, 'z_trams_temps ' + stepper, table,
+                stepper_temps[0], self.step, self.precision)
+        if self.enable_tram and not self.z_trams:
+            raise config.error(
+                "fdc: enable_tram requires z_trams_temps to be specified")
+        # Every temperature from temp_min to temp_max must be in the
+        # tables that are used
+        tables = [self.z_heights]
+        if self.enable_tram:
+            tables.extend(self.z_trams.values())
+        table_min = max([t.temp_min for t in tables])
+        table_max = min([t.temp_max for t in tables])
+        if table_min > table_max:
+            raise config.error(
+                "fdc: z_height_temps and z_trams_temps have no common "
+                "temperature range")
+        self.temp_min = config.getfloat('temp_min', table_min,
+                                        minval=table_min, maxval=table_max)
+        self.temp_max = config.getfloat('temp_max', table_max,
+                                        minval=self.temp_min,
+                                        maxval=table_max)
+        # State, same as the _FDC macro variables
+        self.last_temp = 0.
+        self.last_temp_range = (0., 0.)
+        self.last_coeff = 0.
+        self.last_trams = dict([(s, 0.) for s in self.z_trams])
+        self.disabled_reason = None
+        self.bed_mesh = self.z_thermal_adjust = self.sensor = None
+        self.virtual_sdcard = None
+        self.update_timer = None
+        # Sensor trigger
+        self.sensor_hooked = False
+        self.trigger_temp = None
+        self.check_pending = False
+        self.printer.register_event_handler("klippy:connect",
+                                            self.handle_connect)
+        self.printer.register_event_handler("klippy:ready",
+                                            self.handle_ready)
+        # Print start/end and homing (new ref_temp) don't change the
+        # frame temperature, check the state when they happen
+        for event in ["idle_timeout:printing", "idle_timeout:ready",
+                      "idle_timeout:idle", "homing:home_rails_end"]:
+            self.printer.register_event_handler(event, self._handle_event)
+        self.gcode.register_command('SET_FDC', self.cmd_SET_FDC,
+                                    desc=self.cmd_SET_FDC_help)
+        self.gcode.register_command('QUERY_FDC', self.cmd_QUERY_FDC,
+                                    desc=self.cmd_QUERY_FDC_help)
+        self.gcode.register_command('FDC_APPLY', self.cmd_FDC_APPLY,
+                                    desc=self.cmd_FDC_APPLY_help)
+    def handle_connect(self):
+        self.bed_mesh = self.printer.lookup_object('bed_mesh')
+        self.z_thermal_adjust = self.printer.lookup_object('z_thermal_adjust')
+        self.sensor = self.printer.lookup_object(self.thermistor_name)
+        self.virtual_sdcard = self.printer.lookup_object('virtual_sdcard')
+        self.disabled_reason = self._check_config()
+        if self.disabled_reason is None:
+            self.sensor_hooked = self._hook_sensor()
+    def handle_ready(self):
+        if self.disabled_reason is not None:
+            self.gcode.respond_info("FDC disabled: %s" % (
+                self.disabled_reason,))
+            return
+        if self.sensor_hooked:
+            self._schedule_check()
+            return
+        logging.info("fdc: unable to hook the '%s' sensor callback, "
+                     "polling every %.1fs", self.thermistor_name,
+                     self.update_interval)
+        self.update_timer = self.reactor.register_timer(
+            self._update_event, self.reactor.NOW)
+    def _hook_sensor(self):
+        # Chain the sensor callback of the thermistor_name object, the
+        # object keeps its own callback and FDC sees every new reading
+        sensor = getattr(self.sensor, 'sensor', None)
+        temperature_callback = getattr(self.sensor, 'temperature_callback',
+                                       None)
+        if temperature_callback is None or not hasattr(
+                sensor, 'setup_callback'):
+            return False
+        def callback(read_time, temp):
+            temperature_callback(read_time, temp)
+            # Use the temperature the object reports (z_thermal_adjust
+            # smooths it), the same one the check rounds
+            self._sensor_callback(
+                read_time, self.sensor.get_status(read_time)['temperature'])
+        sensor.setup_callback(callback)
+        return True
+    def _sensor_callback(self, read_time, temp):
+        # Called from the sensor (background) thread, only trigger a
+        # check when the temperature leaves the current step by more
+        # than the hysteresis
+        if not self.enable or self.check_pending:
+            return
+        if (self.trigger_temp is not None and abs(temp - self.trigger_temp)
+                <= self.step * .5 + self.hysteresis):
+            return
+        self.check_pending = True
+        self.reactor.register_async_callback(self._handle_trigger)
+    def _handle_trigger(self, eventtime):
+        self.check_pending = False
+        self._update(eventtime)
+    def _handle_event(self, *args):
+        if self.sensor_hooked and self.disabled_reason is None:
+            self._schedule_check()
+    def _schedule_check(self):
+        if not self.check_pending:
+            self.check_pending = True
+            self.reactor.register_callback(self._handle_trigger)
+    def _check_config(self):
+        if self.z_heights.deltas.tolist() == [999.]:
+            return ("Stock z heights values present! Modify the config to "
+                    "reflect your own values and restart!")
+        if not self.enable_tram:
+            return None
+        for name, count in (('z_tilt', 3), ('quad_gantry_level', 4)):
+            if self.printer.lookup_object(name, None) is None:
+                continue
+            if len(self.z_trams) != count:
+                return ("%s require %d z steppers to be defined in "
+                        "z_trams_temps!" % (name, count))
+        for name in self.bed_mesh.pmgr.get_stepper_names():
+            if name.lower() not in self.z_trams:
+                return ("%s of bed_mesh z_positions is not defined in "
+                        "z_trams_temps!" % (name.lower(),))
+        return None
+    def _round_temp(self, temp):
+        return round_by_step(temp, self.step, self.precision)
+    def _update_event(self, eventtime):
+        self._update(eventtime)
+        return eventtime + self.update_interval
+    def _update(self, eventtime):
+        if not self.enable:
+            return
+        try:
+            self._check_temperature(eventtime)
+        except self.gcode.error as e:
+            self.gcode.respond_info("FDC: %s" % (str(e),))
+        except Exception:
+            logging.exception("fdc: update error")
+    def _check_temperature(self, eventtime):
+        # Rounding current_temp and ref_temp to the step in order to not
+        # be affected by small changes
+        zta_status = self.z_thermal_adjust.get_status(eventtime)
+        ref_temp = self._round_temp(zta_status['z_adjust_ref_temperature'])
+        current_temp = self._round_temp(
+            self.sensor.get_status(eventtime)['temperature'])
+        self.trigger_temp = current_temp
+        is_active = self.virtual_sdcard.get_status(eventtime)['is_active']
+        # change the mesh only if it's needed
+        if is_active and self.last_temp != current_temp:
+            self.apply(current_temp, ref_temp)
+        elif not is_active and self.last_temp != 0:
+            self.reset_state()
+    def apply(self, current_temp, ref_temp):
+        temp_min, temp_max = self.temp_min, self.temp_max
+        if (temp_min <= ref_temp <= temp_max
+                and temp_min <= current_temp <= temp_max
+                and current_temp != ref_temp):
+            self.last_temp = current_temp
+            self.last_temp_range = (ref_temp, current_temp)
+            if self.enable_tram:
+                self._tilt_and_load_mesh(current_temp, ref_temp)
+            else:
+                self._load_mesh(current_temp)
+                self._z_height_adjust(current_temp, ref_temp)
+        elif ref_temp != 0 and (ref_temp > temp_max or ref_temp < temp_min):
+            raise self.gcode.error(
+                "ref_temp or current_temp is out of range %s, %s"
+                % (ref_temp, current_temp))
+    def _load_mesh(self, current_temp):
+        pmgr = self.bed_mesh.pmgr
+        if self.thermal_mesh:
+            pmgr.load_thermal_mesh(current_temp)
+        elif self.deferred_swap:
+            pmgr.load_profile("%s" % (current_temp,), deferred=True)
+        else:
+            pmgr.load_profile("%s" % (current_temp,))
+    def _z_height_adjust(self, current_temp, ref_temp):
+        total_mm = self.z_heights.range_sum(ref_temp, current_temp)
+        # the temp_coeff should be low temp to high temp, z_thermal_adjust
+        # will handle the signs
+        temp_coeff = total_mm / abs(current_temp - ref_temp)
+        if temp_coeff != self.last_coeff:
+            # Same as SET_Z_THERMAL_ADJUST TEMP_COEFF=, works with the
+            # stock bed_mesh too
+            if not -1. <= temp_coeff <= 1.:
+                raise self.gcode.error(
+                    "z_thermal_adjust temp_coeff %s out of range"
+                    % (temp_coeff,))
+            self.z_thermal_adjust.temp_coeff = temp_coeff
+            self.last_coeff = temp_coeff
+    def _is_trammed(self):
+        for name in ('quad_gantry_level', 'z_tilt'):
+            obj = self.printer.lookup_object(name, None)
+            if obj is not None and obj.get_status(
+                    self.reactor.monotonic()).get('applied', False):
+                return True
+        return False
+    def _tilt_and_load_mesh(self, current_temp, ref_temp):
+        if not self._is_trammed():
+            self.gcode.respond_info("Tram enabled but the bed is not trammed!")
+            return
+        # If temps are going up we also need to flip the sign to un-tilt
+        # the bed mesh (from the flat position to the reverse tilt)
+        sign = -1. if current_temp < ref_temp else 1.
+        trams = {}
+        for stepper, table in self.z_trams.items():
+            trams[stepper] = table.range_sum(ref_temp, current_temp) * sign
+        self.last_trams = trams
+        pmgr = self.bed_mesh.pmgr
+        stepper_zs = [trams[name.lower()]
+                      for name in pmgr.get_stepper_names()]
+        self.last_coeff = pmgr.tilt_load_profile(
+            "%s" % (current_temp,), ref_temp, current_temp, stepper_zs,
+            deferred=self.deferred_swap)
+    def reset_state(self):
+        msg = ("FDC: Resting state vars!\nlast_temp: %s to: %s\n"
+               "last_temp_range: %s to: %s\nlast_trams: %s to: %s"
+               % (self.last_temp, 0, list(self.last_temp_range), [],
+                  self.last_trams, dict([(s, 0) for s in self.last_trams])))
+        self.last_temp = 0.
+        self.last_temp_range = (0., 0.)
+        self.last_trams = dict([(s, 0.) for s in self.last_trams])
+        self.gcode.respond_info(msg)
+    def get_status(self, eventtime):
+        return {
+            'enable': int(self.enable),
+            'last_temp': self.last_temp,
+            'last_temp_range': list(self.last_temp_range),
+            'last_coeff': self.last_coeff,
+            'last_trams': dict(self.last_trams),
+            'enable_tram': int(self.enable_tram),
+            'trigger': 'sensor' if self.sensor_hooked else 'poll',
+            'temp_min': self.temp_min,
+            'temp_max': self.temp_max,
+            'step': self.step,
+            'precision': self.precision
+        }
+    cmd_SET_FDC_help = "Enable or disable frame deformation compensation"
+    def cmd_SET_FDC(self, gcmd):
+        self.enable = bool(gcmd.get_int('ENABLE', int(self.enable),
+                                        minval=0, maxval=1))
+        if self.enable:
+            self._handle_event()
+        self.cmd_QUERY_FDC(gcmd)
+    cmd_FDC_APPLY_help = ("Load the mesh and set the z_thermal_adjust "
+                          "coefficient of a temperature")
+    def cmd_FDC_APPLY(self, gcmd):
+        current_temp = self._round_temp(gcmd.get_float('TEMP'))
+        ref_temp = gcmd.get_float('REF', None)
+        if ref_temp is None:
+            zta_status = self.z_thermal_adjust.get_status(
+                self.reactor.monotonic())
+            ref_temp = zta_status['z_adjust_ref_temperature']
+        ref_temp = self._round_temp(ref_temp)
+        for name, temp in (('TEMP', current_temp), ('REF', ref_temp)):
+            if not self.temp_min <= temp <= self.temp_max:
+                raise gcmd.error("FDC_APPLY %s %s is out of range %s to %s"
+                                 % (name, temp, self.temp_min,
+                                    self.temp_max))
+        self.apply(current_temp, ref_temp)
+    cmd_QUERY_FDC_help = "Report the frame deformation compensation state"
+    def cmd_QUERY_FDC(self, gcmd):
+        eventtime = self.reactor.monotonic()
+        zta_status = self.z_thermal_adjust.get_status(eventtime)
+        mesh_status = self.bed_mesh.get_status(eventtime)
+        gcmd.respond_info(
+            "FDC: \n Enabled: %s \n Last temp: %s C \n Mesh profile loaded: "
+            "%s \n current temp coeff: %s \n current last trams: %s \n "
+            "current z adjust: %s \n ref_temp: %s"
+            % (int(self.enable), self.last_temp, mesh_status['profile_name'],
+               self.last_coeff, self.last_trams,
+               zta_status['current_z_adjust'],
+               zta_status['z_adjust_ref_temperature']))
+
+def load_config(config):
+    return FDC(config)
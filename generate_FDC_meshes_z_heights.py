@@ -11,14 +11,19 @@ import json
 import configparser
 import io
 import decimal
+import matplotlib
 import matplotlib.pyplot as plt
 import os
+import glob
+import time
+import contextlib
+import traceback
+import hashlib
+import concurrent.futures
 from scipy.interpolate import make_interp_spline, BSpline
 from scipy.signal import savgol_filter
 import argparse
 
-filter_noise = True
-
 def add_bed_mesh(config, temperature, points, extra_params):
     mesh_template_name = "bed_mesh " + str(temperature)
     config.add_section(mesh_template_name)
@@ -102,6 +107,18 @@ def generate_diff_offsets(new_z_offsets):
     return new_diff_offsets
 
 
+def generate_cumulative_offsets(offsets):
+    # Prefix sums of the per step offsets, the total offset between two temperatures is
+    # cumulative[high] - cumulative[low - step] instead of summing every step in between
+    cumulative = {}
+    total = 0
+    for key, value in offsets.items():
+        total += value
+        cumulative[key] = float(total)
+
+    return cumulative
+
+
 def convert_to_mm(new_z_offsets, step_distance):
     new_offsets_in_mm = {}
     for key, value in new_z_offsets.items():
@@ -110,7 +127,62 @@ def convert_to_mm(new_z_offsets, step_distance):
     return new_offsets_in_mm
 
 
-def generate_z_offsets_plot(all_offsets, step_distance, name, output_path):
+def init_plot_worker():
+    matplotlib.use("Agg")
+
+
+def render_plot(dest, lines, title=None, xlabel=None, ylabel=None, axis=None):
+    # lines is a list of (x, y, label), the plot is saved to dest or shown if dest is None
+    for x, y, label in lines:
+        plt.plot(x, y, label=label)
+    if axis is not None:
+        plt.axis(axis)
+    if xlabel is not None:
+        plt.xlabel(xlabel)
+    if ylabel is not None:
+        plt.ylabel(ylabel)
+    if title is not None:
+        plt.title(title)
+    plt.legend()
+    if dest is None:
+        plt.show()
+    else:
+        plt.savefig(dest, dpi=200)
+    plt.close()
+    return dest
+
+
+class Plots:
+    # Shows the graphs, or with a prefix (--headless) writes them to
+    # prefix + name + ".png", rendered by pool when there is one
+    def __init__(self, prefix=None, pool=None):
+        self.prefix = prefix
+        self.pool = pool
+        self.jobs = []
+        # the png files written (or being rendered)
+        self.written = []
+
+    def save(self, dest, lines, **kwargs):
+        self.written.append(dest)
+        if self.pool is not None:
+            self.jobs.append(self.pool.submit(render_plot, dest, lines, **kwargs))
+        else:
+            render_plot(dest, lines, **kwargs)
+
+    def show(self, name, lines, **kwargs):
+        if self.prefix is not None:
+            self.save(self.prefix + name + ".png", lines, title=name, **kwargs)
+        else:
+            render_plot(None, lines, **kwargs)
+
+    def wait(self):
+        for job in concurrent.futures.as_completed(self.jobs):
+            print("Plot written", job.result())
+        del self.jobs[:]
+
+
+def generate_z_offsets_plot(all_offsets, step_distance, name, output_path, plots):
+    lines = []
     xmin = xmax = ymin = ymax = None
     for stepper, z_offset in all_offsets.items():
         if not bool(z_offset):
@@ -122,7 +194,7 @@ def generate_z_offsets_plot(all_offsets, step_distance, name, output_path):
             first_z = first_z + value
             new_offsets_in_mm.append(first_z)
 
-        plt.plot(list(z_offset.keys()), new_offsets_in_mm, label=stepper)
+        lines.append((list(z_offset.keys()), new_offsets_in_mm, stepper))
         if not xmin or xmin > min(z_offset.keys()):
             xmin = min(z_offset.keys())
         if not xmax or xmax < max(z_offset.keys()):
@@ -132,16 +204,8 @@ def generate_z_offsets_plot(all_offsets, step_distance, name, output_path):
         if not ymax or ymax < max(new_offsets_in_mm):
             ymax = max(new_offsets_in_mm)
 
-    plt.axis([xmin, xmax, ymin, ymax])
-    plt.xlabel('Temperatures [C]')
-    plt.ylabel('Z height [mm]')
-    plt.title(name)
-    plt.legend()
-    plt.savefig(output_path + name + '.png', dpi=200)
-    # plt.show()
-    plt.close()
-
-    return plt
+    plots.save(output_path + name + '.png', lines, title=name, xlabel='Temperatures [C]',
+              ylabel='Z height [mm]', axis=[xmin, xmax, ymin, ymax])
 
 
 def convert_meshes_json_to_list(meshes, step):
@@ -165,10 +229,10 @@ def convert_meshes_json_to_list(meshes, step):
     return one_point, temp_list
 
 
-def filter_noise_list(y):
+def filter_noise_list(y, axis=-1, filter_noise=True):
     if not filter_noise:
         return y
-    new_y = savgol_filter(y, int(len(y)), 5)
+    new_y = savgol_filter(y, int(np.shape(y)[axis]), 5, axis=axis)
     return new_y
     # import statsmodels.api as sm
     #
@@ -177,39 +241,44 @@ def filter_noise_list(y):
     # return new_y[:, 1]
 
 
-def interpolate_list(x,new_x, y):
-    spl = make_interp_spline(x, y, k=3)  # type: BSpline
+def interpolate_list(x,new_x, y, axis=0, filter_noise=True):
+    # y can hold many curves, they are all fit in one call along axis
+    spl = make_interp_spline(x, y, k=3, axis=axis)  # type: BSpline
     new_y = spl(new_x)
-    return filter_noise_list(new_y)
+    return filter_noise_list(new_y, axis, filter_noise)
 
 
-def gen_missing_meshes_by_step_interpolated(meshes, step):
+def fit_error(temp_list, temp_list_new, y, new_y):
+    # max and rms distance of the fit from the measurements, the measured
+    # temperatures are rounded by step so they are points of temp_list_new
+    step = (temp_list_new[-1] - temp_list_new[0]) / max(len(temp_list_new) - 1, 1)
+    index = np.rint((np.asarray(temp_list) - temp_list_new[0]) / step).astype(int)
+    error = np.asarray(new_y)[index] - np.asarray(y)
+    return float(np.abs(error).max()), float(np.sqrt(np.mean(error ** 2)))
+
+
+def interpolate_meshes_by_step(meshes, step, plots, filter_noise=True):
     z_meshes_3d, temp_list = convert_meshes_json_to_list(meshes, step)
     steps_length = int(round((temp_list[-1] - temp_list[0]) / step))
     temp_list_new = np.linspace(temp_list[0], temp_list[-1], steps_length + 1)
-    meshes_2d = np.moveaxis(z_meshes_3d, 0, -1).reshape(-1, len(z_meshes_3d))
-    z_meshes_3d_interpolated = []
-    for point_mesh in meshes_2d:
-        z_smooth = interpolate_list(temp_list, temp_list_new, point_mesh)
-        z_meshes_3d_interpolated.append(z_smooth)
-
-    z_meshes_3d_interpolated = np.array(z_meshes_3d_interpolated)
-    new_meshes = np.moveaxis(z_meshes_3d_interpolated.reshape(len(z_meshes_3d[0]), len(z_meshes_3d[0][0]), len(z_meshes_3d_interpolated[0])), -1, 0)
+    # every mesh point is a curve along the temperature axis
+    new_meshes = interpolate_list(temp_list, temp_list_new, np.asarray(z_meshes_3d, dtype=float),
+                                  filter_noise=filter_noise)
     mesh_params = meshes[list(meshes.keys())[0]]["mesh"]["mesh_params"]
-    new_meshes_parsed = add_bed_meshes(temp_list_new, new_meshes, mesh_params, step)
-    plt.plot(temp_list, meshes_2d[5], label=" before interpolation mesh(random point, 5)")
-    plt.plot(temp_list_new, z_meshes_3d_interpolated[5], label=" interpolated mesh(random point, 5)")
-    plt.legend()
-    plt.show()
-    return new_meshes_parsed
+    meshes_2d = np.moveaxis(z_meshes_3d, 0, -1).reshape(-1, len(z_meshes_3d))
+    z_meshes_3d_interpolated = np.moveaxis(new_meshes, 0, -1).reshape(-1, len(new_meshes))
+    plots.show("mesh interpolation", [(temp_list, meshes_2d[5], " before interpolation mesh(random point, 5)"),
+                                      (temp_list_new, z_meshes_3d_interpolated[5], " interpolated mesh(random point, 5)")])
+    return temp_list_new, new_meshes, mesh_params, fit_error(temp_list, temp_list_new, z_meshes_3d, new_meshes)
 
 
-def gen_z_offsets_per_step_interpolated(z_offsets, stepper, step, step_distance):
-    z_offset_list = []
+def gen_z_offsets_per_step_interpolated(z_offsets, steppers, step, step_distance, plots, filter_noise=True):
+    # the curves of all the steppers are fit together, returns stepper -> offsets
+    z_offset_lists = dict([(stepper, []) for stepper in steppers])
     temp_list = []
     timestamps = sorted(z_offsets.keys())
-    carry = z_offsets[timestamps[0]]["z_pos"][stepper]
-    sum = 0
+    carry = dict(z_offsets[timestamps[0]]["z_pos"])
+    sum = dict([(stepper, 0) for stepper in steppers])
     for i in range(0, len(timestamps), 1):
         temp = round_by_step(z_offsets[timestamps[i]]["frame_temp"], step)
         if temp in temp_list:
@@ -218,28 +287,31 @@ def gen_z_offsets_per_step_interpolated(z_offsets, stepper, step, step_distance)
         if temp_list and temp < max(temp_list):
             print("Temperature %s lower then max, skipping" % temp)
             continue
-        z_offset = (carry - z_offsets[timestamps[i]]["z_pos"][stepper]) * step_distance
-        carry = z_offsets[timestamps[i]]["z_pos"][stepper]
-        sum = z_offset + sum
-        z_offset_list.append(sum)
+        for stepper in steppers:
+            z_offset = (carry[stepper] - z_offsets[timestamps[i]]["z_pos"][stepper]) * step_distance
+            carry[stepper] = z_offsets[timestamps[i]]["z_pos"][stepper]
+            sum[stepper] = z_offset + sum[stepper]
+            z_offset_lists[stepper].append(sum[stepper])
         temp_list.append(temp)
 
     steps_length = int(round((temp_list[-1] - temp_list[0]) / step))
     temp_list_new = np.linspace(temp_list[0], temp_list[-1], steps_length + 1)
-    z_smooth = interpolate_list(temp_list, temp_list_new, z_offset_list)
+    z_smooth_all = interpolate_list(temp_list, temp_list_new, [z_offset_lists[stepper] for stepper in steppers], axis=1,
+                                    filter_noise=filter_noise)
 
-    plt.plot(temp_list, z_offset_list, label=stepper + " before interpolation")
-    plt.plot(temp_list_new, z_smooth, label=stepper + " interpolated")
-    plt.legend()
-    plt.show()
+    all_offsets = {}
+    for stepper, z_smooth in zip(steppers, z_smooth_all):
+        plots.show(stepper + " interpolation", [(temp_list, z_offset_lists[stepper], stepper + " before interpolation"),
+                                                (temp_list_new, z_smooth, stepper + " interpolated")])
 
-    prev_point=0
-    new_offsets_in_mm = {}
-    for i in range(len(z_smooth)):
-        new_offsets_in_mm[round_by_step(temp_list_new[i], step)] = z_smooth[i] - prev_point
-        prev_point = z_smooth[i]
+        prev_point=0
+        new_offsets_in_mm = {}
+        for i in range(len(z_smooth)):
+            new_offsets_in_mm[float(round_by_step(temp_list_new[i], step))] = float(z_smooth[i] - prev_point)
+            prev_point = z_smooth[i]
+        all_offsets[stepper] = new_offsets_in_mm
 
-    return new_offsets_in_mm
+    return all_offsets
 
 
 def gen_z_offsets_per_step(z_offsets, stepper, step, extra_temp, step_distance):
@@ -308,66 +380,360 @@ def write_config(new_meshes, dest):
             f.write(lIndex)
 
 
-def main(args):
-    global filter_noise
-    source_file = args[1]
+def write_profile_store(temp_list, mesh_list, mesh_params, step, dest):
+    # [bed_mesh] profile_store: all the meshes in one float32 .npy file
+    # next to a json index of profile name -> [offset, mesh params index]
+    data_file = os.path.splitext(dest)[0] + ".npy"
+    # same 6 decimals as the points of the cfg profiles
+    points = np.round(np.asarray(mesh_list, dtype=float), 6)
+    mesh_size = points[0].size
+    index = {"version": 1, "data": os.path.basename(data_file), "mesh_params": [mesh_params], "profiles": {}}
+    for i in range(len(temp_list)):
+        name = str(round_by_step(temp_list[i], step))
+        index["profiles"][name] = [i * mesh_size, 0]
+    np.save(data_file, points.astype(np.float32).ravel())
+    with open(dest, "w") as f:
+        json.dump(index, f)
+
+
+def factor_meshes(mesh_list, rank=None, tolerance=0.001):
+    # The frame deforms in a few shapes scaled by temperature: each mesh is
+    # the mean mesh plus a weighted sum of rank basis meshes (principal
+    # components of the stack).  Without a rank, use the smallest one that
+    # rebuilds every mesh within tolerance (mm).
+    meshes = np.asarray(mesh_list, dtype=float)
+    stack = meshes.reshape(len(meshes), -1)
+    mean = stack.mean(axis=0)
+    u, s, vt = np.linalg.svd(stack - mean, full_matrices=False)
+    if rank is None:
+        for rank in range(1, len(s) + 1):
+            error = np.abs((u[:, :rank] * s[:rank]) @ vt[:rank] + mean - stack).max()
+            if error <= tolerance:
+                break
+    rank = min(rank, len(s))
+    weights = u[:, :rank] * s[:rank]
+    basis = vt[:rank]
+    error = weights @ basis + mean - stack
+    max_error = np.abs(error).max()
+    rms_error = np.sqrt(np.mean(error ** 2))
+    return (mean.reshape(meshes.shape[1:]), basis.reshape((rank,) + meshes.shape[1:]), weights,
+            max_error, rms_error)
+
+
+def write_thermal_model(temp_list, mesh_list, mesh_params, step, dest, rank=None, tolerance=0.001):
+    # [bed_mesh] thermal_model: the factored meshes, loaded by BED_MESH_PROFILE THERMAL
+    mean, basis, weights, max_error, rms_error = factor_meshes(mesh_list, rank, tolerance)
+    temps = [round_by_step(temp, step) for temp in temp_list]
+    print("Thermal model: %d meshes -> mean + %d basis meshes, reconstruction error max %.6f mm, rms %.6f mm"
+          % (len(temps), len(basis), max_error, rms_error))
+    with open(dest, "wb") as f:
+        np.savez(f, version=1, temps=temps, mean=mean, basis=basis, weights=weights,
+                 mesh_params=json.dumps(mesh_params))
+
+
+def write_bed_meshes(temp_list, mesh_list, mesh_params, step, dest):
+    # Same output as write_config(add_bed_meshes(...)), without configparser:
+    # each mesh is formatted with a single format string and written to the file
+    params = "".join(["#*# %s = %s\n" % (key.lower(), str(value).replace("\n", "\n#*# \t"))
+                      for key, value in mesh_params.items()])
+    with open(dest, "w") as f:
+        for i in range(len(temp_list)):
+            mesh = np.asarray(mesh_list[i], dtype=float)
+            row_format = "#*# \t" + ", ".join(["%f"] * mesh.shape[1]) + "\n"
+            f.write("#*# [bed_mesh %s]\n#*# version = 1\n#*# points = \n" % (round_by_step(temp_list[i], step),))
+            f.write(row_format * mesh.shape[0] % tuple(mesh.ravel().tolist()))
+            f.write("#*# \t\n")
+            f.write(params)
+            f.write("#*# \n")
+
+
+# the variables get_fdc_variables sets in the FDC template
+FDC_VARIABLES = ("variable_z_height_temps", "variable_z_height_cum", "variable_last_trams", "variable_z_trams_temps",
+                 "variable_z_trams_cum", "variable_enable_tram", "variable_temp_min", "variable_temp_max",
+                 "variable_step", "variable_precision")
+
+
+def get_fdc_variables(all_z_offsets, all_z_tram_offsets, tramming, step):
+    # name -> value of the FDC macro variables, in the order of FDC.cfg
+    variables = {}
+    variables["variable_z_height_temps"] = all_z_offsets["stepper_z"]
+    variables["variable_z_height_cum"] = generate_cumulative_offsets(all_z_offsets["stepper_z"])
+    variables["variable_last_trams"] = gen_init_last_trams(all_z_tram_offsets)
+    if tramming:
+        variables["variable_z_trams_temps"] = all_z_offsets
+        variables["variable_z_trams_cum"] = dict([(stepper, generate_cumulative_offsets(offsets))
+                                                  for stepper, offsets in all_z_offsets.items()])
+        variables["variable_enable_tram"] = 1
+    else:
+        variables["variable_z_trams_temps"] = gen_init_empty_z_trams(all_z_tram_offsets)
+        # empty, the macros use the cumulative tables when they are present
+        variables["variable_z_trams_cum"] = {}
+        variables["variable_enable_tram"] = 0
+    variables["variable_temp_min"] = list(all_z_offsets["stepper_z"].keys())[0]
+    variables["variable_temp_max"] = list(all_z_offsets["stepper_z"].keys())[-1]
+    variables["variable_step"] = step
+    variables["variable_precision"] = precision(step)
+    return variables
+
+
+def format_fdc_variables(variables):
+    lines = []
+    for name, value in variables.items():
+        # same grouping as the macro
+        if name in ("variable_last_trams", "variable_temp_min"):
+            lines.append("")
+        lines.append("%s: %s" % (name, value))
+    return "\n".join(lines) + "\n"
+
+
+def get_fdc_variable_pattern(name):
+    return re.compile(r"^%s:.*$" % (re.escape(name),), re.MULTILINE)
+
+
+def check_fdc_template(template, template_file):
+    # checked before the fit, render_fdc_config needs every variable line
+    missing = [name for name in FDC_VARIABLES if not get_fdc_variable_pattern(name).search(template)]
+    if missing:
+        raise Exception("%s not found in the FDC template %s" % (", ".join(missing), template_file))
+
+
+def render_fdc_config(template, variables):
+    # the FDC.cfg macro with the generated values on its variable_ lines
+    for name, value in variables.items():
+        pattern = get_fdc_variable_pattern(name)
+        if not pattern.search(template):
+            raise Exception("%s not found in the FDC template" % (name,))
+        template = pattern.sub(lambda m: "%s: %s" % (name, value), template, count=1)
+    return template
+
+
+def get_cache_key(data, template, options, plots):
+    # hash of everything the outputs depend on: the json data, the FDC
+    # template, the options, where the graphs go and this script
+    key = hashlib.sha256()
+    with open(__file__, "rb") as f:
+        key.update(f.read())
+    key.update(data.encode())
+    key.update(template.encode())
+    key.update(json.dumps([options.step, options.filter_noise, options.profile_store, options.thermal_model,
+                           options.model_rank, options.model_tolerance, options.headless, plots.prefix]).encode())
+    return key.hexdigest()
+
+
+def read_cache(cache_file, key):
+    # the result of the last run if its key matches and its outputs still exist
+    try:
+        with open(cache_file, "r") as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if cache.get("key") != key or not all([os.path.exists(output) for output in cache["outputs"]]):
+        return None
+    return cache["result"]
+
+
+def write_cache(cache_file, key, outputs, result):
+    result = dict([(name, value) for name, value in result.items() if name != "variables"])
+    with open(cache_file, "w") as f:
+        json.dump({"key": key, "outputs": outputs, "result": result}, f)
+
+
+def generate_fdc(source_file, options, plots):
+    # Fits one thermal_quant_*.json and writes its outputs, returns the FDC
+    # variables and the fit statistics.  Skipped when the inputs match the
+    # <name>_FDC_cache.json of the last run.
+    start_time = time.perf_counter()
+    step = options.step
     dest_file = source_file[:-5] + '_NEW.cfg'
-
-    parser = argparse.ArgumentParser(description='Generate FDC data')
-    parser.add_argument('--step', default=0.1, metavar='--S', type=float,
-                        help='The resolution of the generated data, default is 0.1 which means a data point will'
-                             ' be generated for every 0.1C temperature')
-    parser.add_argument('--filter_noise', default=True, metavar='--FN', action=argparse.BooleanOptionalAction,
-                        help='Enable filtering noise for a smoother graph. if the generated graphs don\'t look right, disable it')
-
-    args_parser, unknown = parser.parse_known_args()
-    step = args_parser.step
-    filter_noise = args_parser.filter_noise
+    fdc_file = source_file[:-5] + '_FDC.cfg'
+    cache_file = source_file[:-5] + '_FDC_cache.json'
 
     # Read the thermal_quant_*.json
     with open(source_file, "r") as f:
         data = f.read()
+    with open(options.fdc_template, "r") as f:
+        template = f.read()
+    check_fdc_template(template, options.fdc_template)
+
+    cache_key = get_cache_key(data, template, options, plots)
+    if not options.force:
+        result = read_cache(cache_file, cache_key)
+        if result is not None:
+            print("%s is unchanged, skipping (--force to generate it again)" % (source_file,))
+            result["cached"] = True
+            return result
 
     thermal_data = json.loads(data)
     step_distance = thermal_data["metadata"]["z_axis"]["step_dist"]
     tramming = thermal_data["hot_mesh"][list(thermal_data["hot_mesh"].keys())[0]]["z_pos_after_tram"]
     steppers = list(thermal_data["hot_mesh"][list(thermal_data["hot_mesh"].keys())[0]]["z_pos"].keys())
-    new_meshes = gen_missing_meshes_by_step_interpolated(thermal_data["hot_mesh"], step)
-    all_z_offsets = {}
+    temp_list_new, mesh_list, mesh_params, mesh_fit = interpolate_meshes_by_step(
+        thermal_data["hot_mesh"], step, plots, options.filter_noise)
     all_z_tram_offsets = {}
 
+    all_z_offsets = gen_z_offsets_per_step_interpolated(thermal_data["hot_mesh"], steppers, step, step_distance,
+                                                        plots, options.filter_noise)
     for stepper in steppers:
         all_z_tram_offsets[stepper] = gen_z_offsets_per_step(thermal_data["hot_mesh"], stepper, step,0, step_distance)
-        all_z_offsets[stepper] = gen_z_offsets_per_step_interpolated(thermal_data["hot_mesh"], stepper, step, step_distance)
         debug_prints(thermal_data["hot_mesh"], all_z_offsets[stepper], all_z_tram_offsets[stepper], stepper,step_distance)
 
-    generate_z_offsets_plot(all_z_offsets, step_distance, "z offsets", source_file[:-5])
+    generate_z_offsets_plot(all_z_offsets, step_distance, "z offsets", source_file[:-5], plots)
 
     if tramming:
-        generate_z_offsets_plot(all_z_tram_offsets, step_distance, "z tram offsets", source_file[:-5])
+        generate_z_offsets_plot(all_z_tram_offsets, step_distance, "z tram offsets", source_file[:-5], plots)
 
+    variables = get_fdc_variables(all_z_offsets, all_z_tram_offsets, tramming, step)
     print("\n############################ COPY FROM HERE COPY FROM HERE COPY FROM HERE ####################################\n")
-    print("variable_z_height_temps:", all_z_offsets["stepper_z"])
-    print("")
-    print("variable_last_trams:", gen_init_last_trams(all_z_tram_offsets))
+    print(format_fdc_variables(variables))
 
-    if tramming:
-        print("variable_z_trams_temps:", all_z_offsets)
-        print("variable_enable_tram: 1")
+    print("\n")
+    print("Writing file", dest_file)
+    write_bed_meshes(temp_list_new, mesh_list, mesh_params, step, dest_file)
+    print("Writing FDC config", fdc_file)
+    with open(fdc_file, "w") as f:
+        f.write(render_fdc_config(template, variables))
+    outputs = [dest_file, fdc_file] + plots.written
+    if options.profile_store is not None:
+        store_file = os.path.splitext(options.profile_store)[0] + ".json"
+        print("Writing profile store", store_file)
+        write_profile_store(temp_list_new, mesh_list, mesh_params, step, store_file)
+        outputs += [store_file, os.path.splitext(store_file)[0] + ".npy"]
+    if options.thermal_model is not None:
+        model_file = os.path.splitext(options.thermal_model)[0] + ".npz"
+        print("Writing thermal model", model_file)
+        write_thermal_model(temp_list_new, mesh_list, mesh_params, step, model_file,
+                            options.model_rank, options.model_tolerance)
+        outputs.append(model_file)
+    print("\n\n")
+
+    result = {"file": source_file, "variables": variables, "meshes": len(mesh_list), "steppers": len(steppers),
+              "tramming": bool(tramming), "temp_min": variables["variable_temp_min"],
+              "temp_max": variables["variable_temp_max"], "z_drift": sum(all_z_offsets["stepper_z"].values()),
+              "mesh_fit_max": mesh_fit[0], "mesh_fit_rms": mesh_fit[1],
+              "seconds": time.perf_counter() - start_time, "cached": False}
+    write_cache(cache_file, cache_key, outputs, result)
+    return result
+
+
+def find_fleet_files(source):
+    # a directory of thermal_quant_*.json files or a glob, None for a single file
+    if os.path.isdir(source):
+        files = glob.glob(os.path.join(source, "thermal_quant_*.json"))
+    elif any(c in source for c in "*?["):
+        files = glob.glob(source)
     else:
-        print("variable_z_trams_temps:", gen_init_empty_z_trams(all_z_tram_offsets))
-        print("variable_enable_tram: 0")
+        return None
+    # skip the json outputs (cache, profile store) of the other files
+    prefixes = tuple([f[:-5] + "_" for f in files])
+    return sorted([f for f in files if not f.startswith(prefixes)])
+
+
+def generate_fleet_file(source_file, options):
+    # Runs in the fleet pool: the console output of the file goes to
+    # <name>_FDC.log and the graphs to png files
+    prefix = source_file[:-5] + "_"
+    options = argparse.Namespace(**vars(options))
+    if options.profile_store is not None:
+        options.profile_store = prefix + os.path.basename(options.profile_store)
+    if options.thermal_model is not None:
+        options.thermal_model = prefix + os.path.basename(options.thermal_model)
+    with open(prefix + "FDC.log", "w") as log, contextlib.redirect_stdout(log):
+        try:
+            result = generate_fdc(source_file, options, Plots(prefix))
+        except Exception as e:
+            traceback.print_exc(file=log)
+            return {"file": source_file, "error": "%s: %s" % (type(e).__name__, e)}
+    return result
+
+
+def print_fleet_summary(results, seconds):
+    print("%-40s %6s %13s %8s %5s %11s %11s %8s" % (
+        "file", "meshes", "temps [C]", "steppers", "tram", "z drift mm", "mesh fit mm", "time s"))
+    for result in results:
+        name = os.path.basename(result["file"])
+        if "error" in result:
+            print("%-40s FAILED %s" % (name, result["error"]))
+            continue
+        print("%-40s %6d %13s %8d %5s %11.4f %11.4f %8s" % (
+            name, result["meshes"], "%s-%s" % (result["temp_min"], result["temp_max"]), result["steppers"],
+            "yes" if result["tramming"] else "no", result["z_drift"], result["mesh_fit_max"],
+            "cached" if result["cached"] else "%.2f" % (result["seconds"],)))
+    failed = len([result for result in results if "error" in result])
+    cached = len([result for result in results if result.get("cached")])
+    print("%d files, %d failed, %d unchanged, %.2f s" % (len(results), failed, cached, seconds))
+
+
+def generate_fleet(source_files, options):
+    start_time = time.perf_counter()
+    print("Generating %d files with %s processes" % (len(source_files), options.jobs or os.cpu_count()))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=options.jobs, initializer=init_plot_worker) as pool:
+        jobs = [pool.submit(generate_fleet_file, source_file, options) for source_file in source_files]
+        for job in concurrent.futures.as_completed(jobs):
+            result = job.result()
+            print("Done" if "error" not in result else "FAILED", result["file"])
+        results = [job.result() for job in jobs]
     print("")
-    print("variable_temp_min:", list(all_z_offsets["stepper_z"].keys())[0])
-    print("variable_temp_max:", list(all_z_offsets["stepper_z"].keys())[-1])
-    print("variable_step:", step)
-    print("variable_precision:", precision(step))
+    print_fleet_summary(results, time.perf_counter() - start_time)
 
-    print("\n\n")
-    print("Writing file", dest_file)
-    write_config(new_meshes, dest_file)
-    print("\n\n")
-    print("Copy the vars above to the FDC macro, and don't forget to copy the new bed meshes!")
+
+def main(args):
+    source_file = args[1]
+
+    parser = argparse.ArgumentParser(description='Generate FDC data')
+    parser.add_argument('--step', default=0.1, metavar='--S', type=float,
+                        help='The resolution of the generated data, default is 0.1 which means a data point will'
+                             ' be generated for every 0.1C temperature')
+    parser.add_argument('--filter_noise', default=True, metavar='--FN', action=argparse.BooleanOptionalAction,
+                        help='Enable filtering noise for a smoother graph. if the generated graphs don\'t look right, disable it')
+
+    parser.add_argument('--profile_store', default=None, metavar='FILE',
+                        help='Also write the meshes to a binary profile store (FILE.json index and FILE.npy data),'
+                             ' set [bed_mesh] profile_store to FILE.json to use it')
+
+    parser.add_argument('--thermal_model', default=None, metavar='FILE',
+                        help='Also write a low rank thermal model (FILE.npz),'
+                             ' set [bed_mesh] thermal_model to FILE.npz to use it')
+    parser.add_argument('--model_rank', default=None, type=int,
+                        help='Basis meshes of the thermal model, default is the smallest rank within --model_tolerance')
+    parser.add_argument('--model_tolerance', default=0.001, type=float,
+                        help='Max reconstruction error of the thermal model in mm, default 0.001')
+
+    parser.add_argument('--headless', default=False, action='store_true',
+                        help='Don\'t show the graphs, write them to png files next to the json file instead')
+    parser.add_argument('--jobs', default=None, type=int,
+                        help='Processes used when the source is a directory or a glob, default is one per core')
+
+    parser.add_argument('--fdc_template', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'FDC.cfg'),
+                        metavar='FILE', help='The FDC macro the <name>_FDC.cfg is rendered from,'
+                                             ' default is the FDC.cfg next to this script')
+    parser.add_argument('--force', default=False, action='store_true',
+                        help='Generate even if the json file, the template and the options are unchanged'
+                             ' since the last run')
+
+    options, unknown = parser.parse_known_args()
+
+    fleet_files = find_fleet_files(source_file)
+    if fleet_files is not None:
+        if not fleet_files:
+            print("No thermal_quant json files found in", source_file)
+            return
+        generate_fleet(fleet_files, options)
+        return
+
+    plots = Plots()
+    if options.headless:
+        # the plots are rendered in other processes while the data is generated
+        matplotlib.use("Agg")
+        plots = Plots(source_file[:-5] + "_",
+                      concurrent.futures.ProcessPoolExecutor(initializer=init_plot_worker))
+
+    result = generate_fdc(source_file, options, plots)
+    if not result["cached"]:
+        print("Include the new FDC config or copy the vars above to the FDC macro,"
+              " and don't forget to copy the new bed meshes!")
+    if options.headless:
+        plots.wait()
+        plots.pool.shutdown()
 
 
 def gen_init_last_trams(all_z_tram_offsets):